@@ -0,0 +1,148 @@
+'''
+Asyncio versions of the API scrapers.
+
+Each async scraper wraps a configured synchronous scraper, e.g.
+
+    scraper = AsyncLegistarAPIBillScraper(ChicagoBillScraper(),
+                                          concurrency=20)
+
+    histories = await asyncio.gather(*(scraper.history(matter_id)
+                                       for matter_id in matter_ids))
+
+    async for matter in scraper.matters(since_datetime=since):
+        ...
+
+Requests are still made by the synchronous scraper, on a pool of
+`concurrency` threads, so retries and accept_response behave as they
+do for the synchronous scraper. The threads take turns with the
+scraper's throttle, so its requests_per_minute bounds the requests of
+all of them together. To bound them together with other scrapers'
+requests, give the scrapers a shared legistar.ratelimit.RateLimiter.
+'''
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .bills import LegistarAPIBillScraper
+from .events import LegistarAPIEventScraperBase
+from .people import LegistarAPIPersonScraper
+
+
+_EXHAUSTED = object()
+
+
+def _coroutine(name):
+    async def method(self, *args, **kwargs):
+        return await self._run(getattr(self.scraper, name), *args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+def _async_generator(name):
+    async def method(self, *args, **kwargs):
+        iterator = iter(getattr(self.scraper, name)(*args, **kwargs))
+        try:
+            while True:
+                item = await self._run(next, iterator, _EXHAUSTED)
+                if item is _EXHAUSTED:
+                    return
+                yield item
+        finally:
+            if hasattr(iterator, 'close'):
+                await self._run(iterator.close)
+
+    method.__name__ = name
+    return method
+
+
+class AsyncLegistarAPIScraper(object):
+    scraper_class = None
+
+    def __init__(self, scraper, concurrency=10):
+        if self.scraper_class and not isinstance(scraper, self.scraper_class):
+            raise TypeError('{} wraps a {}, not a {}'.format(
+                type(self).__name__,
+                self.scraper_class.__name__,
+                type(scraper).__name__))
+
+        self.scraper = scraper
+        self.concurrency = concurrency
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        # Keep a connection open for every request we might have in
+        # flight
+        for prefix in ('http://', 'https://'):
+            scraper.mount(prefix, requests.adapters.HTTPAdapter(
+                pool_connections=concurrency,
+                pool_maxsize=concurrency))
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        self._executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    get_json = _coroutine('get_json')
+    search = _async_generator('search')
+    pages = _async_generator('pages')
+
+
+class AsyncLegistarAPIBillScraper(AsyncLegistarAPIScraper):
+    scraper_class = LegistarAPIBillScraper
+
+    matters = _async_generator('matters')
+    matter = _coroutine('matter')
+    endpoint = _coroutine('endpoint')
+    code_sections = _coroutine('code_sections')
+    attachments = _coroutine('attachments')
+    votes = _coroutine('votes')
+    history = _coroutine('history')
+    sponsors = _coroutine('sponsors')
+    text = _coroutine('text')
+    legislation_detail_url = _coroutine('legislation_detail_url')
+
+    async def topics(self, *args, **kwargs):
+        '''
+        Unlike LegistarAPIBillScraper.topics, this always returns a list
+        '''
+        return await self._run(lambda: list(self.scraper.topics(*args, **kwargs)))
+
+    async def relations(self, matter_id):
+        return await self._run(lambda: list(self.scraper.relations(matter_id)))
+
+
+class AsyncLegistarAPIEventScraper(AsyncLegistarAPIScraper):
+    '''
+    event() can be gathered. With a LegistarAPIEventScraperZip, the
+    calls take turns walking the scraper's one web calendar, so only
+    their API requests overlap.
+    '''
+    scraper_class = LegistarAPIEventScraperBase
+
+    api_events = _async_generator('api_events')
+    events = _async_generator('events')
+    event = _coroutine('event')
+    agenda = _async_generator('agenda')
+    minutes = _async_generator('minutes')
+    rollcalls = _async_generator('rollcalls')
+
+
+class AsyncLegistarAPIPersonScraper(AsyncLegistarAPIScraper):
+    scraper_class = LegistarAPIPersonScraper
+
+    body_types = _coroutine('body_types')
+    bodies = _async_generator('bodies')
+    body_offices = _async_generator('body_offices')
+    person_sources_from_office = _coroutine('person_sources_from_office')
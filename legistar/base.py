@@ -1,8 +1,17 @@
+import contextlib
 import datetime
+import hashlib
+import heapq
+import html
 import itertools
+import queue
+import threading
 import traceback
-from collections import defaultdict, deque
+from collections import deque, OrderedDict
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 import re
+from urllib.parse import unquote
 import requests
 import json
 import logging
@@ -12,6 +21,9 @@ import lxml.html
 import lxml.etree as etree
 import pytz
 
+from . import odata
+from .ratelimit import RateLimitedSession
+
 
 class LegistarSession(requests.Session):
 
@@ -50,11 +62,13 @@ class LegistarSession(requests.Session):
 
             expected_range = 'All Years'
 
-            page = lxml.html.fromstring(response.text)
-            returned_range, = page.xpath(
-                "//input[@id='ctl00_ContentPlaceHolder1_lstYears_Input']")
+            years_input = YEARS_INPUT.search(response.text)
+            if years_input is None:
+                raise ValueError('No year range in response')
 
-            returned_range = returned_range.value
+            returned_range = VALUE_ATTRIBUTE.search(years_input.group(0))
+            if returned_range is not None:
+                returned_range = html.unescape(returned_range.group(1))
 
             if returned_range != expected_range:
                 response.status_code = 520
@@ -62,7 +76,7 @@ class LegistarSession(requests.Session):
                 # contain the correct payload data.  This comes as a
                 # result of not updating the payload via sessionSecrets:
                 # so, we do that here.
-                payload.update(self.sessionSecrets(page))
+                payload.update(textSecrets(response.text))
 
                 raise scrapelib.HTTPError(response)
 
@@ -73,60 +87,306 @@ class LegistarSession(requests.Session):
         return all_range
 
 
-class LegistarScraper(scrapelib.Scraper, LegistarSession):
+class LegistarScraper(scrapelib.Scraper, RateLimitedSession, LegistarSession):
     date_format = '%m/%d/%Y'
 
+    # How many parsed pages lxmlize keeps, so that e.g. legDetails,
+    # history and text can share one fetch of a bill's detail page.
+    # Pages we post back from are fetched with freshPage instead.
+    PAGE_CACHE_SIZE = 8
+
+    # How many ViewState and event validation values of uncached pages,
+    # e.g. the pages of a grid, to hold on to for sessionSecrets. Those
+    # of cached pages are kept for as long as the pages are.
+    SECRETS_KEPT = 32
+
+    # How many rows a page we ask grids for before paging through them
+    GRID_PAGE_SIZE = 1000
+
+    # How many of the most recent rows legislation() and events() check
+    # new rows against, since rows can shift between pages mid-scrape
+    DEDUP_WINDOW = 1000
+
+    # How many detail pages to fetch at once when following the links
+    # in a grid
+    DETAIL_WORKERS = 4
+
     def __init__(self, *args, **kwargs):
         super(LegistarScraper, self).__init__(*args, **kwargs)
+        self._secrets = OrderedDict()
+        self._cached_secrets = {}
+        self._secrets_lock = threading.Lock()
+
+        self._page_cache = OrderedDict()
+        self._page_cache_lock = threading.Lock()
+        self.page_cache_hits = 0
+        self.page_cache_misses = 0
+
+        self.checkpoint_store = None
+
+        self._throttle_lock = threading.Lock()
+
+        # Scrapers that don't get a logger elsewhere, e.g. from a pupa
+        # Scraper, log like the API scrapers
+        if not hasattr(self, 'warning'):
+            self.logger = logging.getLogger("legistar")
+            self.warning = self.logger.warning
+
+    def _throttle(self):
+        # withDetails fetches pages from several threads at once, and
+        # scrapelib's throttle isn't thread safe, so they take turns
+        with self._throttle_lock:
+            super()._throttle()
 
     def lxmlize(self, url, payload=None):
         '''
-        Gets page and returns as XML
+        Gets page and returns as XML. The last PAGE_CACHE_SIZE pages
+        are cached by url and payload, so don't modify the pages.
+        '''
+        if not self.PAGE_CACHE_SIZE:
+            return self.freshPage(url, payload)
+
+        key = (url, tuple(sorted(payload.items())) if payload else None)
+
+        with self._page_cache_lock:
+            page = self._page_cache.get(key)
+            if page is not None:
+                self._page_cache.move_to_end(key)
+                self.page_cache_hits += 1
+                return page
+            self.page_cache_misses += 1
+
+        page = self.freshPage(url, payload)
+        self._keepSecrets(page)
+
+        with self._page_cache_lock:
+            self._page_cache[key] = page
+            while len(self._page_cache) > self.PAGE_CACHE_SIZE:
+                _, evicted = self._page_cache.popitem(last=False)
+                self._dropSecrets(evicted)
+
+        return page
+
+    def freshPage(self, url, payload=None):
+        '''
+        Gets page and returns as XML, without the page cache. The .NET
+        state of a cached page may have expired, so use this for pages
+        whose ViewState we are going to post back.
+        '''
+        return self._parse(self._fetch(url, payload), url)
+
+    def invalidatePages(self, url=None):
+        '''
+        Forget the cached pages for a url, whatever their payload, or
+        all cached pages if no url is given.
         '''
+        with self._page_cache_lock:
+            if url is None:
+                keys = list(self._page_cache)
+            else:
+                keys = [key for key in self._page_cache if key[0] == url]
+
+            for key in keys:
+                self._dropSecrets(self._page_cache.pop(key))
+
+    def _fetch(self, url, payload=None):
         if payload:
             response = self.post(url, payload, verify=False)
         else:
             response = self.get(url, verify=False)
-        entry = response.text
-        page = lxml.html.fromstring(entry)
+        return response.text
+
+    def _parse(self, text, url):
+        '''
+        The ViewState of a page can be hundreds of kilobytes, so we
+        swap it, and the event validation, for a short placeholder
+        before building the tree. sessionSecrets swaps them back.
+        '''
+        text = HIDDEN_SECRET.sub(self._stashSecret, text)
+        page = lxml.html.fromstring(text)
         page.make_links_absolute(url)
         return page
 
-    def pages(self, url, payload=None):
-        page = self.lxmlize(url, payload)
+    def _stashSecret(self, match):
+        tag = match.group(0)
+        value = VALUE_ATTRIBUTE.search(tag)
+        if value is None:
+            return tag
+
+        with self._secrets_lock:
+            placeholder = SECRET_PLACEHOLDER + str(next(SECRET_IDS))
+            self._secrets[placeholder] = html.unescape(value.group(1))
+            while len(self._secrets) > self.SECRETS_KEPT:
+                self._secrets.popitem(last=False)
+
+        return tag[:value.start(1)] + placeholder + tag[value.end(1):]
+
+    def _unstashSecret(self, value):
+        if not value.startswith(SECRET_PLACEHOLDER):
+            return value
+
+        with self._secrets_lock:
+            secret = self._secrets.get(value) or self._cached_secrets.get(value)
+
+        if secret is None:
+            raise ValueError('The ViewState of this page is no longer kept. '
+                             'Fetch the page again, or raise SECRETS_KEPT.')
+
+        return secret
+
+    def _keepSecrets(self, page):
+        '''
+        Keep the secrets of a page that is going in the page cache for
+        as long as the page is cached
+        '''
+        with self._secrets_lock:
+            for placeholder in SECRET_VALUES(page):
+                if placeholder in self._secrets:
+                    self._cached_secrets[placeholder] = self._secrets.pop(placeholder)
+
+    def _dropSecrets(self, page):
+        with self._secrets_lock:
+            for placeholder in SECRET_VALUES(page):
+                self._cached_secrets.pop(placeholder, None)
+
+    def pages(self, url, payload=None, checkpoint=None):
+        '''
+        Yield each page of a grid. If a Checkpoint is given, save it
+        before requesting each page after the first, and if it was
+        saved in the middle of a walk, resume from there. If the pages
+        aren't consumed to the end, the Checkpoint is cleared, unless
+        they are consumed within Checkpoint.walk, which only clears it
+        if the walk was stopped rather than failed.
+        '''
+        # Find the ViewState and next page in the text of each page,
+        # rather than in its tree
+        if checkpoint is not None and checkpoint.resumable:
+            url = checkpoint.state['url']
+            payload = checkpoint.state['payload']
+
+            text = self._fetch(url, payload)
+            event_target = nextPageTarget(text)
+
+        else:
+            text = self._fetch(url, payload)
+
+            event_target = nextPageTarget(text)
+            if payload and 'ctl00$ContentPlaceHolder1$btnSearch' in payload:
+                del payload['ctl00$ContentPlaceHolder1$btnSearch']
+
+            if event_target and self.GRID_PAGE_SIZE:
+                if payload is None:
+                    payload = {}
 
-        yield page
+                text, event_target = self._maximizePageSize(url, payload,
+                                                            text, event_target)
 
-        next_page = page.xpath(
-            "//a[@class='rgCurrentPage']/following-sibling::a[1]")
-        if payload and 'ctl00$ContentPlaceHolder1$btnSearch' in payload:
-            del payload['ctl00$ContentPlaceHolder1$btnSearch']
+        try:
+            yield self._parse(text, url)
+
+            while event_target:
+                if payload is None:
+                    payload = {}
+
+                payload.update(textSecrets(text))
+
+                payload['__EVENTTARGET'] = event_target
+
+                if checkpoint is not None:
+                    checkpoint.save(url=url, payload=payload)
+
+                text = self._fetch(url, payload)
+
+                yield self._parse(text, url)
+
+                event_target = nextPageTarget(text)
+
+            if checkpoint is not None:
+                checkpoint.save(url=None, payload=None)
+
+        except GeneratorExit:
+            # Within Checkpoint.walk, the walk decides whether it was
+            # stopped or failed
+            if checkpoint is not None and not checkpoint.walking:
+                checkpoint.clear()
+            raise
+
+    def checkpoint(self, *key):
+        '''
+        A Checkpoint, in the scraper's checkpoint_store, for the walk
+        identified by key
+        '''
+        return Checkpoint(self.checkpoint_store,
+                          ':'.join(str(part) for part in key))
+
+    def _maximizePageSize(self, url, payload, text, event_target):
+        '''
+        Ask the grid we are about to page through for GRID_PAGE_SIZE
+        rows a page. Returns the text and next page target of the first
+        page at the new size, or of the page we had, if the grid
+        doesn't resize.
+        '''
+        table_view = gridTableView(text, event_target)
+        if table_view is None:
+            return text, event_target
 
-        while len(next_page) > 0:
-            if payload is None:
-                payload = {}
+        unique_id, page_size = table_view
+        if page_size >= self.GRID_PAGE_SIZE:
+            return text, event_target
 
-            payload.update(self.sessionSecrets(page))
+        resize = dict(payload, **textSecrets(text))
+        resize['__EVENTTARGET'] = unique_id.rsplit('$', 1)[0]
+        resize['__EVENTARGUMENT'] = 'FireCommand:{};PageSize;{}'.format(
+            unique_id, self.GRID_PAGE_SIZE)
 
-            event_target = next_page[0].attrib['href'].split("'")[1]
+        try:
+            resized = self._fetch(url, resize)
+        except scrapelib.HTTPError as e:
+            self.warning('Could not resize grid {}: {}'.format(unique_id, e))
+            return text, event_target
 
-            payload['__EVENTTARGET'] = event_target
+        next_page = nextPageTarget(resized)
+        if gridTableView(resized, next_page) != (unique_id, self.GRID_PAGE_SIZE):
+            return text, event_target
 
-            page = self.lxmlize(url, payload)
+        return resized, next_page
 
-            yield page
+    def withDetails(self, rows, fetch):
+        '''
+        Yield (row, fetch(row)) for each row of a grid page, in order,
+        calling fetch for DETAIL_WORKERS rows at a time. fetch should
+        return None for rows without details.
+        '''
+        return ordered_map(fetch, rows, self.DETAIL_WORKERS)
 
-            next_page = page.xpath(
-                "//a[@class='rgCurrentPage']/following-sibling::a[1]")
+    def clone(self):
+        '''
+        A copy of the scraper with the same settings, but its own
+        cookies, connections, cached pages and ViewStates, so that the
+        copy can run a chain of postbacks alongside the scraper's own
+        '''
+        # Not copy.copy, which would only copy the attributes that
+        # requests.Session pickles
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        clone.headers = self.headers.copy()
+        clone.cookies = requests.cookies.RequestsCookieJar()
+        clone.adapters = OrderedDict(self.adapters)
+        for prefix in ('https://', 'http://'):
+            clone.mount(prefix, requests.adapters.HTTPAdapter())
+        clone._page_cache = OrderedDict()
+        clone._page_cache_lock = threading.Lock()
+        clone._secrets = OrderedDict()
+        clone._cached_secrets = {}
+        clone._secrets_lock = threading.Lock()
+        clone._throttle_lock = threading.Lock()
+        return clone
 
     def parseDetails(self, detail_div):
         """
         Parse the data in the top section of a detail page.
         """
-        detail_query = ".//*[starts-with(@id, 'ctl00_ContentPlaceHolder1_lbl')"\
-                       "     or starts-with(@id, 'ctl00_ContentPlaceHolder1_hyp')"\
-                       "     or starts-with(@id, 'ctl00_ContentPlaceHolder1_Label')]"
-        fields = detail_div.xpath(detail_query)
+        fields = DETAIL_FIELDS(detail_div)
 
         details = {}
 
@@ -136,9 +396,11 @@ class LegistarScraper(scrapelib.Scraper, LegistarSession):
 
             key = field_1.text_content().replace(':', '').strip()
 
-            if field_2.find('.//a') is not None:
+            links = list(field_2.iterdescendants('a'))
+
+            if links:
                 value = []
-                for link in field_2.xpath('.//a'):
+                for link in links:
                     value.append({'label': link.text_content().strip(),
                                   'url': self._get_link_address(link)})
 
@@ -146,45 +408,53 @@ class LegistarScraper(scrapelib.Scraper, LegistarSession):
                 value = {'label': field_2.text_content().strip(),
                          'url': self._get_link_address(field_2)}
 
-            elif self._parse_detail(key, field_1, field_2):
-                value = self._parse_detail(key, field_1, field_2)
-
             else:
-                value = field_2.text_content().strip()
+                value = (self._parse_detail(key, field_1, field_2) or
+                         field_2.text_content().strip())
 
             details[key] = value
 
         return details
 
-    def parseDataTable(self, table):
+    def parseDataTable(self, table, compact=False):
         """
         Legistar uses the same kind of data table in a number of
         places. This will return a list of dictionaries using the
         table headers as keys.
+
+        If compact is True, rows are returned as Row objects, which
+        share their keys with the other rows of the table, instead of
+        dictionaries, and without the row elements, so that the
+        page can be freed as soon as it has been parsed.
         """
-        headers = table.xpath(".//th[starts-with(@class, 'rgHeader')]")
-        rows = table.xpath(".//tr[@class='rgRow' or @class='rgAltRow']")
+        headers = TABLE_HEADERS(table)
+        rows = TABLE_ROWS(table)
 
         keys = []
         for header in headers:
             text_content = header.text_content().replace('&nbsp;', ' ').strip()
-            inputs = header.xpath('.//input')
             if text_content:
                 keys.append(text_content)
-            elif len(inputs) > 0:
-                keys.append(header.xpath('.//input')[0].value)
             else:
-                keys.append(header.xpath('.//img')[0].get('alt'))
+                inputs = HEADER_INPUTS(header)
+                if inputs:
+                    keys.append(inputs[0].value)
+                else:
+                    keys.append(HEADER_IMAGES(header)[0].get('alt'))
+
+        schemas = {}
 
         for row in rows:
             try:
-                data = defaultdict(lambda: None)
+                row_keys = []
+                values = []
 
-                for key, field in zip(keys, row.xpath("./td")):
+                for key, field in zip(keys, row.iterchildren('td')):
                     text_content = self._stringify(field)
 
-                    if field.find('.//a') is not None:
-                        address = self._get_link_address(field.find('.//a'))
+                    link = next(field.iterdescendants('a'), None)
+                    if link is not None:
+                        address = self._get_link_address(link)
                         if address:
                             if key.strip() in ['', 'ics'] and 'View.ashx?M=IC' in address:
                                 key = 'iCalendar'
@@ -197,9 +467,16 @@ class LegistarScraper(scrapelib.Scraper, LegistarSession):
                     else:
                         value = text_content
 
-                    data[key] = value
+                    row_keys.append(key)
+                    values.append(value)
 
-                yield dict(data), keys, row
+                if compact:
+                    row_keys = tuple(row_keys)
+                    if row_keys not in schemas:
+                        schemas[row_keys] = RowSchema(row_keys)
+                    yield Row(schemas[row_keys], values), keys, None
+                else:
+                    yield dict(zip(row_keys, values)), keys, row
 
             except Exception as e:
                 print('Problem parsing row:')
@@ -232,12 +509,17 @@ class LegistarScraper(scrapelib.Scraper, LegistarSession):
         return None
 
     def _stringify(self, field):
-        for br in field.xpath("*//br"):
-            br.tail = "\n" + br.tail if br.tail else "\n"
-        for em in field.xpath("*//em"):
-            if em.text:
-                em.text = "--em--" + em.text + "--em--"
-        return field.text_content().replace('&nbsp;', ' ').strip()
+        """
+        The text of a table cell, with line breaks and emphasis marked
+        up, for line breaks and emphasis below the cell's immediate
+        children.
+        """
+        if not MARKED_UP(field):
+            return field.text_content().replace('&nbsp;', ' ').strip()
+
+        parts = []
+        _cell_text(field, 0, parts)
+        return ''.join(parts).replace('&nbsp;', ' ').strip()
 
     def toTime(self, text):
         time = datetime.datetime.strptime(text, self.date_format)
@@ -258,11 +540,11 @@ class LegistarScraper(scrapelib.Scraper, LegistarSession):
 
         payload = {}
         payload['__EVENTARGUMENT'] = None
-        payload['__VIEWSTATE'] = page.xpath(
-            "//input[@name='__VIEWSTATE']/@value")[0]
+        payload['__VIEWSTATE'] = self._unstashSecret(page.xpath(
+            "//input[@name='__VIEWSTATE']/@value")[0])
         try:
-            payload['__EVENTVALIDATION'] = page.xpath(
-                "//input[@name='__EVENTVALIDATION']/@value")[0]
+            payload['__EVENTVALIDATION'] = self._unstashSecret(page.xpath(
+                "//input[@name='__EVENTVALIDATION']/@value")[0])
         except IndexError:
             pass
 
@@ -274,24 +556,538 @@ class LegistarScraper(scrapelib.Scraper, LegistarSession):
         return super().accept_response(response, **kwargs)
 
 
+# Hidden ASP.NET inputs, and the pager links, as they appear in the
+# text of a page
+HIDDEN_SECRET = re.compile(
+    r'<input\b[^>]*?\sname="(__VIEWSTATE|__EVENTVALIDATION)"[^>]*>')
+VALUE_ATTRIBUTE = re.compile(r'\svalue="([^"]*)"')
+CURRENT_PAGE = re.compile(
+    r'<a\b[^>]*\sclass="rgCurrentPage"[^>]*>.*?</a>\s*(<a\b[^>]*>)?', re.S)
+HREF = re.compile(r'\shref="([^"]*)"')
+# The table views of grids, in the grids' client side settings
+TABLE_VIEW = re.compile(r'\\"UniqueID\\":\\"([^\\]*)\\",\\"PageSize\\":(\d+)')
+YEARS_INPUT = re.compile(
+    r'<input\b[^>]*\sid="ctl00_ContentPlaceHolder1_lstYears_Input"[^>]*>')
+
+SECRET_PLACEHOLDER = 'legistar-secret-'
+SECRET_IDS = itertools.count()
+
+
+def textSecrets(text):
+    '''
+    Like LegistarScraper.sessionSecrets, for the text of a page
+    '''
+    payload = {'__EVENTARGUMENT': None}
+    for match in HIDDEN_SECRET.finditer(text):
+        value = VALUE_ATTRIBUTE.search(match.group(0))
+        if value is not None:
+            payload.setdefault(match.group(1), html.unescape(value.group(1)))
+
+    if '__VIEWSTATE' not in payload:
+        raise IndexError('No __VIEWSTATE in page')
+
+    return payload
+
+
+def nextPageTarget(text):
+    '''
+    The __doPostBack target of the link after the current page in a
+    grid pager, or None on the last page
+    '''
+    for match in CURRENT_PAGE.finditer(text):
+        if match.group(1):
+            href = HREF.search(match.group(1))
+            if href is not None:
+                return html.unescape(href.group(1)).split("'")[1]
+
+
+def gridTableView(text, event_target=None):
+    '''
+    The unique id and page size of the grid table view that a
+    __doPostBack target belongs to, or of the first table view on the
+    page if there is no target
+    '''
+    if event_target is not None:
+        event_target = unquote(event_target)
+
+    for match in TABLE_VIEW.finditer(text):
+        unique_id, page_size = match.groups()
+        if event_target is None or event_target.startswith(unique_id + '$'):
+            return unique_id, int(page_size)
+
+
+class Checkpoint(object):
+    '''
+    Where a walk through the pages of a grid got to: the url and
+    payload, with its ViewState and event target, of the request for
+    the next page, how many rows the scraper has emitted, and anything
+    else the scraper wants to save. Checkpoints are saved in a
+    legistar.stores.CheckpointStore, so a walk that fails can be
+    resumed from the last good page in a new process.
+    '''
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.state = store.get(key) or {'rows': 0}
+        self.walking = False
+
+    @staticmethod
+    @contextlib.contextmanager
+    def walk(checkpoint):
+        '''
+        Wrap a scraper's walk, a generator, in this, so that if the
+        walk's consumer stops early, or the walk is done, the next walk
+        starts from the top. If an exception escapes the walk, whether
+        it came from a request or from parsing a page, the checkpoint
+        is kept. The checkpoint can be None.
+        '''
+        if checkpoint is None:
+            yield
+            return
+
+        checkpoint.walking = True
+        try:
+            yield
+        except GeneratorExit:
+            checkpoint.clear()
+            raise
+        else:
+            checkpoint.clear()
+        finally:
+            checkpoint.walking = False
+
+    @property
+    def resumable(self):
+        return self.state.get('payload') is not None
+
+    @property
+    def rows(self):
+        return self.state.get('rows', 0)
+
+    def emit(self, rows=1):
+        self.state['rows'] = self.rows + rows
+
+    def save(self, **state):
+        self.state.update(state)
+        self.store.set(self.key, self.state)
+
+    def clear(self):
+        self.state = {'rows': 0}
+        self.store.delete(self.key)
+
+
 def fieldKey(x):
     field_id = x.attrib['id']
-    field = re.split(r'hyp|lbl|Label', field_id)[-1]
+    field = FIELD_PREFIX.split(field_id)[-1]
     field = field.split('Prompt')[0]
     field = field.rstrip('X21')
     return field
 
 
-class LegistarAPIScraper(scrapelib.Scraper):
+FIELD_PREFIX = re.compile(r'hyp|lbl|Label')
+
+
+DETAIL_FIELDS = etree.XPath(
+    ".//*[starts-with(@id, 'ctl00_ContentPlaceHolder1_lbl')"
+    "     or starts-with(@id, 'ctl00_ContentPlaceHolder1_hyp')"
+    "     or starts-with(@id, 'ctl00_ContentPlaceHolder1_Label')]")
+
+TABLE_HEADERS = etree.XPath(".//th[starts-with(@class, 'rgHeader')]")
+TABLE_ROWS = etree.XPath(".//tr[@class='rgRow' or @class='rgAltRow']")
+HEADER_INPUTS = etree.XPath('.//input')
+HEADER_IMAGES = etree.XPath('.//img')
+SECRET_VALUES = etree.XPath(
+    "//input[@name='__VIEWSTATE' or @name='__EVENTVALIDATION']/@value")
+
+# Line breaks and emphasis below a cell's immediate children
+MARKED_UP = etree.XPath('boolean(*//br | *//em)')
+
+
+def _cell_text(element, depth, parts):
+    '''
+    Collect the text of an element, like text_content does, but
+    putting a newline after line breaks and wrapping emphasized text
+    in '--em--' when they are at least two levels below the cell.
+    '''
+    text = element.text
+    if text:
+        if depth >= 2 and element.tag == 'em':
+            text = '--em--' + text + '--em--'
+        parts.append(text)
+
+    for child in element:
+        # Comments and processing instructions have no text content,
+        # but their tails do
+        if isinstance(child.tag, str):
+            _cell_text(child, depth + 1, parts)
+
+        tail = child.tail
+        if depth + 1 >= 2 and child.tag == 'br':
+            tail = '\n' + tail if tail else '\n'
+        if tail:
+            parts.append(tail)
+
+
+class RowSchema(object):
+    '''
+    The keys of the values of a compact Row. If there are duplicate
+    keys, the last value for a key wins, as it would in a dictionary.
+    '''
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = {key: i for i, key in enumerate(keys)}
+        self.unique_keys = tuple(dict.fromkeys(keys))
+        self._extended = {}
+
+    def extend(self, key):
+        if key not in self._extended:
+            self._extended[key] = RowSchema(self.keys + (key,))
+        return self._extended[key]
+
+
+class Row(MutableMapping):
+    '''
+    A row of a data table that stores its values by position, and
+    shares its keys with the other rows of the table. It behaves like
+    the dictionary that parseDataTable would otherwise return, except
+    that keys can't be deleted.
+    '''
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, schema, values):
+        self._schema = schema
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._schema.index[key]]
+
+    def __setitem__(self, key, value):
+        index = self._schema.index.get(key)
+        if index is None:
+            # Rows that get the same new key will share a schema
+            self._schema = self._schema.extend(key)
+            self._values.append(value)
+        else:
+            self._values[index] = value
+
+    def __delitem__(self, key):
+        raise TypeError('Cannot delete keys from a Row')
+
+    def __iter__(self):
+        return iter(self._schema.unique_keys)
+
+    def __len__(self):
+        return len(self._schema.unique_keys)
+
+    def __repr__(self):
+        return 'Row({!r})'.format(dict(self))
+
+
+class RecentSet(object):
+    '''
+    A set that remembers the last `maxlen` items added to it, or every
+    item if maxlen is None, with constant time membership tests. Counts
+    the duplicates it is asked to add.
+    '''
+    def __init__(self, maxlen=None):
+        self.maxlen = maxlen
+        self.duplicates = 0
+        self._items = OrderedDict()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        '''
+        Add an item, returning True if it is new, and False, counting
+        a duplicate, if it is one of the last maxlen items added
+        '''
+        if item in self._items:
+            self.duplicates += 1
+            return False
+
+        self._items[item] = None
+        if self.maxlen is not None and len(self._items) > self.maxlen:
+            self._items.popitem(last=False)
+
+        return True
+
+
+def record_digest(record):
+    '''
+    A digest of a record, e.g. a matter and its subresources, which
+    changes when the record does
+    '''
+    def default(value):
+        if isinstance(value, Mapping):
+            return dict(value)
+        return str(value)
+
+    serialized = json.dumps(record, sort_keys=True, default=default)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def ordered_map(func, items, workers):
+    '''
+    Yield (item, func(item)) for each item, in order, calling func on
+    a pool of `workers` threads, for only a few items ahead of the one
+    we are waiting on
+    '''
+    if workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        window = deque()
+        try:
+            for item in items:
+                window.append((item, executor.submit(func, item)))
+
+                if len(window) > workers:
+                    item, future = window.popleft()
+                    yield item, future.result()
+
+            while window:
+                item, future = window.popleft()
+                yield item, future.result()
+        finally:
+            for _, future in window:
+                future.cancel()
+
+
+def prefetch(items, size):
+    '''
+    Iterate over items on a background thread, staying up to `size`
+    items ahead of the consumer. If the consumer stops early, the
+    thread stops too, once it is done with the item it is getting.
+    '''
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(items)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def iter_json_array(chunks):
+    '''
+    Incrementally decode a JSON array from an iterable of text
+    chunks, yielding each element as soon as it has been read.
+    '''
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+
+    buffer = ''
+    position = 0
+    in_array = False
+
+    for chunk in itertools.chain(chunks, [None]):
+        finished = chunk is None
+        if not finished:
+            buffer = buffer[position:] + chunk
+            position = 0
+
+        while True:
+            position = separators.match(buffer, position).end()
+            if position == len(buffer):
+                break
+
+            if not in_array:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array')
+                in_array = True
+                position += 1
+                continue
+
+            if buffer[position] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if finished:
+                    raise
+                break
+
+            # A number at the end of the buffer might be continued in
+            # the next chunk
+            if end == len(buffer) and not finished:
+                break
+
+            yield item
+            position = end
+
+    raise ValueError('Unterminated JSON array')
+
+
+class LegistarAPIScraper(scrapelib.Scraper, RateLimitedSession):
     date_format = '%Y-%m-%dT%H:%M:%S'
     time_string_format = '%I:%M %p'
     utc_timestamp_format = '%Y-%m-%dT%H:%M:%S.%f'
 
+    # The API returns at most 1000 items per request
+    PAGE_SIZE = 1000
+
+    # Number of pages to request at once. Override to fetch pages
+    # concurrently.
+    PAGE_WORKERS = 1
+
+    # Page by the last seen $orderby and item_key values, rather than
+    # by $skip offset.
+    KEYSET_PAGINATION = False
+
+    # Decode API pages incrementally, as they are downloaded
+    STREAM_PAGES = False
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    # The API rejects filters with more terms than this. Filters
+    # built with legistar.odata are split into several queries to
+    # stay under the limit.
+    MAX_FILTER_TERMS = 16
+    SUBQUERY_WORKERS = 4
+
+    # How many of the most recent items pages() checks new items
+    # against, since items can shift between pages mid-scrape
+    DEDUP_WINDOW = 1000
+
+    # How many records an incremental scrape yields between saves of
+    # its high water mark
+    STATE_SAVE_INTERVAL = 100
+
     def __init__(self, *args, **kwargs):
         super(LegistarAPIScraper, self).__init__(*args, **kwargs)
         self.logger = logging.getLogger("legistar")
         self.warning = self.logger.warning
 
+        # Set to a legistar.stores.ResponseCache to revalidate
+        # responses from get_json, instead of downloading them again
+        self.revalidation_cache = None
+
+        # Set to a legistar.stores.StateStore for incremental scrapes
+        # to pick up where the last scrape finished
+        self.state_store = None
+
+        # Set to a legistar.stores.DigestStore to skip records that
+        # haven't changed since they were last scraped
+        self.digest_store = None
+
+        self._throttle_lock = threading.Lock()
+
+    def _throttle(self):
+        # Several threads can make requests at once, e.g. in
+        # legislation_detail_urls, and scrapelib's throttle isn't
+        # thread safe, so they take turns
+        with self._throttle_lock:
+            super()._throttle()
+
+    def skip_unchanged(self, records, resource, record_id, hydrated=None):
+        '''
+        If the scraper has a digest_store, yield only the records that
+        are new or have changed since they were last yielded, and log
+        how many were skipped. record_id is a function that returns the
+        id of a record, or None if the record should always be yielded.
+        hydrated, if given, is a function that returns what to digest
+        for a record, e.g. the record along with its subresources.
+        '''
+        if self.digest_store is None:
+            yield from records
+            return
+
+        skipped = 0
+
+        for record in records:
+            key = record_id(record)
+            if key is None:
+                yield record
+                continue
+
+            digest = record_digest(record if hydrated is None else hydrated(record))
+            if self.digest_store.get(self.BASE_URL, resource, key) == digest:
+                skipped += 1
+                continue
+
+            yield record
+
+            # Only once the record has been dealt with
+            self.digest_store.set(self.BASE_URL, resource, key, digest)
+
+        if skipped:
+            self.logger.info('Skipped {} unchanged {}'.format(skipped, resource))
+
+    def high_water_mark(self, resource):
+        if self.state_store is not None:
+            return self.state_store.get(self.BASE_URL, resource)
+
+    def track_high_water_mark(self, records, resource, field):
+        '''
+        Yield records, which are in order of `field`, a last modified
+        time, saving the time up to which every record has been yielded
+        to the state_store as we go, and when we are done.
+        '''
+        if self.state_store is None:
+            yield from records
+            return
+
+        done = None
+        last = None
+        unsaved = 0
+
+        for record in records:
+            last_modified = record.get(field)
+
+            # We have moved on from the records modified at `last`
+            if last_modified is not None and last is not None and last_modified != last:
+                done = last
+
+            yield record
+
+            if last_modified is not None:
+                last = last_modified
+
+            unsaved += 1
+            if done is not None and unsaved >= self.STATE_SAVE_INTERVAL:
+                self.state_store.set(self.BASE_URL, resource, done)
+                unsaved = 0
+
+        if last is not None:
+            self.state_store.set(self.BASE_URL, resource, last)
+
     def toTime(self, text):
         time = datetime.datetime.strptime(text, self.date_format)
         time = pytz.timezone(self.TIMEZONE).localize(time)
@@ -308,7 +1104,46 @@ class LegistarAPIScraper(scrapelib.Scraper):
         time = pytz.timezone('UTC').localize(time)
         return time
 
-    def search(self, route, item_key, search_conditions):
+    def get_json(self, url):
+        '''
+        Get and decode a JSON response. If there is a revalidation
+        cache, a response we have already seen is only downloaded
+        again if it has changed.
+        '''
+        if self.revalidation_cache is None:
+            return self.get(url).json()
+
+        cached = self.revalidation_cache.get(url)
+
+        headers = {}
+        if cached:
+            etag, last_modified, age, body = cached
+
+            if not (etag or last_modified):
+                if age < self.revalidation_cache.ttl:
+                    return json.loads(body)
+            else:
+                if etag:
+                    headers['If-None-Match'] = etag
+                if last_modified:
+                    headers['If-Modified-Since'] = last_modified
+
+        response = self.get(url, headers=headers)
+
+        if response.status_code == 304 and cached:
+            self.revalidation_cache.touch(url)
+            return json.loads(body)
+
+        if response.status_code == 200:
+            self.revalidation_cache.set(url,
+                                        response.headers.get('ETag'),
+                                        response.headers.get('Last-Modified'),
+                                        response.text)
+
+        return response.json()
+
+    def search(self, route, item_key, search_conditions, keyset=None,
+               fields=None):
         """
         Base function for searching the Legistar API.
 
@@ -320,14 +1155,21 @@ class LegistarAPIScraper(scrapelib.Scraper):
                     might be MatterId or EventId
         search_conditions -- a string in the OData format for the
                              your search conditions http://www.odata.org/documentation/odata-version-3-0/url-conventions/#url5.1.2
-
-                             It would be nice if we could provide a
-                             friendly search API. Something like https://github.com/tuomur/python-odata
+                             or a filter built with legistar.odata. Built
+                             filters with too many terms for the API are
+                             split into several searches.
+        keyset -- Page through results by item_key, instead of by
+                  offset. Defaults to the KEYSET_PAGINATION class
+                  attribute.
+        fields -- The fields to return for each item. item_key is always
+                  returned. By default, all fields are returned.
 
 
         Examples:
         # Search for bills introduced after Jan. 1, 2017
         search('/matters/', 'MatterId', "MatterIntroDate gt datetime'2017-01-01'")
+        search('/matters/', 'MatterId',
+               odata.Field('MatterIntroDate').gt(datetime.date(2017, 1, 1)))
         """
 
         search_url = self.BASE_URL + route
@@ -337,33 +1179,252 @@ class LegistarAPIScraper(scrapelib.Scraper):
         try:
             yield from self.pages(search_url,
                                   params=params,
-                                  item_key=item_key)
+                                  item_key=item_key,
+                                  keyset=keyset,
+                                  fields=fields)
         except requests.HTTPError as e:
             if e.response.status_code == 400:
                 raise ValueError(e.response.json()['Message'])
             if not self.accept_response(e.response):
                 raise
 
-    def pages(self, url, params=None, item_key=None):
+    def pages(self, url, params=None, item_key=None, workers=None,
+              keyset=None, stream=None, fields=None):
+        """
+        Page through an API route, 1000 items at a time, and yield
+        the items, skipping any item whose item_key we have recently
+        seen.
+
+        If workers is greater than one (it defaults to the
+        PAGE_WORKERS class attribute), that many pages are requested
+        at once. Items are still yielded in the order the API returns
+        them.
+
+        If keyset is True (it defaults to the KEYSET_PAGINATION class
+        attribute), pages are requested by filtering on the $orderby
+        and item_key values of the last item of the previous page,
+        instead of by $skip offset. Pages are then requested one at a
+        time.
+
+        If stream is True (it defaults to the STREAM_PAGES class
+        attribute), items are decoded and yielded as the response
+        body arrives, instead of after the whole page has been read.
+        Concurrently fetched pages are always read whole.
+
+        If fields are given, only those fields are requested, along
+        with item_key and the $orderby fields, which the pager needs.
+
+        If the $filter is a legistar.odata filter with more terms than
+        the API accepts, it is split into several filters, whose
+        results are fetched concurrently and merged in $orderby order.
+        """
         if params is None:
             params = {}
 
-        seen = deque([], maxlen=1000)
+        if fields is not None:
+            params['$select'] = self._select(fields, item_key,
+                                             params.get('$orderby'))
+
+        if keyset is None:
+            keyset = self.KEYSET_PAGINATION
+
+        if stream is None:
+            stream = self.STREAM_PAGES
+
+        search_filter = params.get('$filter')
+        if isinstance(search_filter, odata.Filter):
+            # Leave room for the terms that keyset pagination adds
+            max_terms = self.MAX_FILTER_TERMS - (3 if keyset else 0)
+            subfilters = search_filter.split(max_terms)
+
+            if len(subfilters) > 1:
+                yield from self._split_pages(url, params, item_key,
+                                             subfilters, keyset)
+                return
+
+            params['$filter'] = str(search_filter)
+
+        if keyset:
+            yield from self._keyset_pages(url, params, item_key, stream)
+            return
+
+        if workers is None:
+            workers = self.PAGE_WORKERS
+
+        if workers > 1:
+            items = self._concurrent_pages(url, params, workers)
+        else:
+            items = self._serial_pages(url, params, stream)
+
+        seen = RecentSet(self.DEDUP_WINDOW)
 
+        for item in items:
+            if seen.add(item[item_key]):
+                yield item
+
+        if seen.duplicates:
+            self.logger.info('Skipped {} duplicate items from {}'.format(
+                seen.duplicates, url))
+
+    def _serial_pages(self, url, params, stream):
         page_num = 0
-        response = None
-        while page_num == 0 or len(response.json()) == 1000:
-            params['$skip'] = page_num * 1000
-            response = self.get(url, params=params)
+        page_length = None
+        while page_length is None or page_length == self.PAGE_SIZE:
+            params['$skip'] = page_num * self.PAGE_SIZE
+            response = self.get(url, params=params, stream=stream)
             response.raise_for_status()
 
-            for item in response.json():
-                if item[item_key] not in seen:
-                    yield item
-                    seen.append(item[item_key])
+            page_length = 0
+            for page_length, item in enumerate(self._page_items(response, stream), 1):
+                yield item
 
             page_num += 1
 
+    def _concurrent_pages(self, url, params, workers):
+        '''
+        Keep a window of `workers` pages in flight. Since we don't know
+        how many pages there are, we keep requesting pages until one of
+        them comes back short, and then drop any requests for pages
+        beyond it.
+        '''
+        def get_page(page_num):
+            page_params = dict(params)
+            page_params['$skip'] = page_num * self.PAGE_SIZE
+            response = self.get(url, params=page_params)
+            response.raise_for_status()
+            return response.json()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            window = deque(executor.submit(get_page, page_num)
+                           for page_num in range(workers))
+            next_page = workers
+
+            try:
+                while window:
+                    items = window.popleft().result()
+
+                    yield from items
+
+                    if len(items) < self.PAGE_SIZE:
+                        break
+
+                    window.append(executor.submit(get_page, next_page))
+                    next_page += 1
+
+            finally:
+                for future in window:
+                    future.cancel()
+
+    def _keyset_pages(self, url, params, item_key, stream):
+        '''
+        Since every page is selected by a filter on indexed values, deep
+        pages cost the same as the first one, and rows that are
+        inserted or shifted while we scrape can't make us revisit
+        items, so there is no need to keep track of what we've seen.
+        '''
+        order_field = params.get('$orderby', item_key)
+        if not re.fullmatch(r'\w+', order_field):
+            raise ValueError('Keyset pagination requires a single, ascending '
+                             '$orderby field, not {!r}'.format(order_field))
+
+        page_params = dict(params)
+        page_params['$top'] = self.PAGE_SIZE
+        if order_field != item_key:
+            page_params['$orderby'] = '{},{}'.format(order_field, item_key)
+        else:
+            page_params['$orderby'] = item_key
+
+        search_filter = params.get('$filter')
+
+        page_length = None
+        last_item = None
+        while page_length is None or page_length == self.PAGE_SIZE:
+            if last_item:
+                after = odata.keyset(order_field,
+                                     last_item[order_field],
+                                     item_key,
+                                     last_item[item_key])
+                if search_filter:
+                    after = '({}) and ({})'.format(search_filter, after)
+                page_params['$filter'] = after
+
+            response = self.get(url, params=page_params, stream=stream)
+            response.raise_for_status()
+
+            page_length = 0
+            for page_length, last_item in enumerate(self._page_items(response, stream), 1):
+                yield last_item
+
+    def _split_pages(self, url, params, item_key, subfilters, keyset):
+        '''
+        Page through the results of each filter, and merge them as if
+        they had come from a single query. The first SUBQUERY_WORKERS
+        filters are paged through in the background, a page ahead of
+        the merge.
+        '''
+        orderby = [term.split() for term in params.get('$orderby', '').split(',')
+                   if term.strip()]
+        descending = {len(term) > 1 and term[1].lower() == 'desc'
+                      for term in orderby}
+        if len(descending) > 1:
+            raise ValueError('Cannot merge results ordered by {!r}'.format(
+                params['$orderby']))
+        reverse = descending.pop() if descending else False
+
+        sort_fields = [term[0] for term in orderby] + [item_key]
+
+        def sort_key(item):
+            # Nulls sort first, as they do in the API
+            return [(item[field] is not None, item[field])
+                    for field in sort_fields]
+
+        # Have the API return each filter's items in sort_key order.
+        # Keyset pagination already breaks ties by item_key.
+        subquery_params = dict(params)
+        if not keyset and item_key not in sort_fields[:-1]:
+            tie_break = item_key + (' desc' if reverse else '')
+            if orderby:
+                tie_break = params['$orderby'] + ',' + tie_break
+            subquery_params['$orderby'] = tie_break
+
+        def search(subfilter):
+            return self.pages(url,
+                              params=dict(subquery_params, **{'$filter': subfilter}),
+                              item_key=item_key,
+                              workers=1,
+                              keyset=keyset)
+
+        results = [search(subfilter) for subfilter in subfilters]
+        results = [prefetch(result, self.PAGE_SIZE) if i < self.SUBQUERY_WORKERS else result
+                   for i, result in enumerate(results)]
+
+        # An item that several filters match comes out of the merge
+        # once for each of them, one after the other
+        seen = RecentSet(self.DEDUP_WINDOW)
+        for item in heapq.merge(*results, key=sort_key, reverse=reverse):
+            if seen.add(item[item_key]):
+                yield item
+
+    def _select(self, fields, item_key, orderby=None):
+        selected = list(fields) + [item_key]
+        if orderby:
+            selected += [term.split()[0] for term in orderby.split(',')]
+
+        # Remove duplicates, keeping the order of the requested fields
+        return ','.join(dict.fromkeys(selected))
+
+    def _page_items(self, response, stream):
+        if stream:
+            # Without an encoding, requests hands back bytes rather
+            # than text
+            if response.encoding is None:
+                response.encoding = 'utf-8'
+            chunks = response.iter_content(chunk_size=self.STREAM_CHUNK_SIZE,
+                                           decode_unicode=True)
+            return iter_json_array(chunks)
+        else:
+            return response.json()
+
     def accept_response(self, response, **kwargs):
         """
         This overrides a method that controls whether
@@ -1,38 +1,113 @@
-from .base import LegistarScraper, LegistarAPIScraper
+from .base import (LegistarScraper, LegistarAPIScraper, Checkpoint, RecentSet,
+                   ordered_map)
+from . import odata
 from lxml.etree import tostring
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partialmethod
 from urllib.parse import urljoin
+import itertools
+import types
 import requests
 import scrapelib
 
 
 class LegistarBillScraper(LegistarScraper):
+    # How many date windows of a search to scrape at once, and how many
+    # times to retry a window that fails
+    WINDOW_WORKERS = 4
+    WINDOW_RETRIES = 2
+
     def legislation(self, search_text='', created_after=None,
-                    created_before=None):
+                    created_before=None, compact=False, window=None):
+        """
+        Yield the summaries of the legislation that matches a search.
+
+        If window is given, as a datetime.timedelta, the range between
+        created_after and created_before is split into windows of that
+        length, which are searched WINDOW_WORKERS at a time, oldest
+        window first.
+        """
+        if window is not None:
+            yield from self._windowedLegislation(search_text, created_after,
+                                                 created_before, compact, window)
+            return
 
         # If legislation is added to the the legistar system while we
         # are scraping, it will shift the list of legislation down and
         # we might revisit the same legislation. So, we keep track of
         # the last few pieces of legislation we've visited in order to
         # make sure we are not revisiting
-        scraped_leg = deque([], maxlen=10)
-
-        for page in self.searchLegislation(search_text, created_after,
-                                           created_before):
-            for legislation_summary in self.parseSearchResults(page):
-                if not legislation_summary['url'] in scraped_leg:
+        scraped_leg = RecentSet(self.DEDUP_WINDOW)
+
+        # If the scraper has a checkpoint_store, pick up where an
+        # earlier, unfinished, walk through the results left off
+        checkpoint = None
+        if self.checkpoint_store is not None:
+            checkpoint = self.checkpoint('legislation', self.LEGISLATION_URL,
+                                         search_text, created_after, created_before)
+
+        with Checkpoint.walk(checkpoint):
+            for page in self.searchLegislation(search_text, created_after,
+                                               created_before, checkpoint):
+                for legislation_summary in self.parseSearchResults(page, compact):
+                    if scraped_leg.add(legislation_summary['url']):
+                        yield legislation_summary
+                        if checkpoint is not None:
+                            checkpoint.emit()
+
+        if scraped_leg.duplicates:
+            self.logger.info('Skipped {} duplicate pieces of legislation'.format(
+                scraped_leg.duplicates))
+
+    def _windowedLegislation(self, search_text, created_after, created_before,
+                             compact, window):
+        if created_after is None or created_before is None:
+            raise ValueError('Searching by window needs both created_after '
+                             'and created_before')
+
+        windows = []
+        start = created_after
+        while start < created_before:
+            end = min(start + window, created_before)
+            windows.append((start, end))
+            start = end
+
+        def search(dates):
+            # A retried search picks up from its last good page, if the
+            # scraper has a checkpoint_store, or starts over
+            results = []
+            for attempt in itertools.count(1):
+                try:
+                    for summary in self.clone().legislation(search_text, *dates,
+                                                            compact=compact):
+                        results.append(summary)
+                    return results
+                except requests.RequestException as e:
+                    if attempt > self.WINDOW_RETRIES:
+                        raise
+                    self.warning('Retrying search for legislation created '
+                                 '{} to {}: {}'.format(*dates, e))
+
+        # Consecutive windows share a day, so the same legislation can
+        # turn up in two windows
+        scraped_leg = RecentSet()
+
+        for _, results in ordered_map(search, windows, self.WINDOW_WORKERS):
+            for legislation_summary in results:
+                if scraped_leg.add(legislation_summary['url']):
                     yield legislation_summary
-                    scraped_leg.append(legislation_summary['url'])
 
     def searchLegislation(self, search_text='', created_after=None,
-                          created_before=None):
+                          created_before=None, checkpoint=None):
         """
         Submit a search query on the legislation search page, and return a list
         of summary results.
         """
+        if checkpoint is not None and checkpoint.resumable:
+            return self.pages(self.LEGISLATION_URL, checkpoint=checkpoint)
 
-        page = self.lxmlize(self.LEGISLATION_URL)
+        page = self.freshPage(self.LEGISLATION_URL)
 
         page = self._advancedSearch(page)
 
@@ -62,18 +137,21 @@ class LegistarBillScraper(LegistarScraper):
 
         payload.update(self.sessionSecrets(page))
 
-        return self.pages(self.LEGISLATION_URL, payload)
+        return self.pages(self.LEGISLATION_URL, payload, checkpoint)
 
-    def parseSearchResults(self, page):
+    def parseSearchResults(self, page, compact=False):
         """Take a page of search results and return a sequence of data
         of tuples about the legislation, of the form
 
         ('Document ID', 'Document URL', 'Type', 'Status', 'Introduction Date'
         'Passed Date', 'Main Sponsor', 'Title')
+
+        If compact is True, the results are compact Rows, rather than
+        dictionaries.
         """
         table = page.xpath(
             "//table[@id='ctl00_ContentPlaceHolder1_gridMain_ctl00']")[0]
-        for legislation, headers, row in self.parseDataTable(table):
+        for legislation, headers, row in self.parseDataTable(table, compact):
             # Do legislation search-specific stuff
             # ------------------------------------
             # First column should be the ID of the record.
@@ -100,7 +178,7 @@ class LegistarBillScraper(LegistarScraper):
             payload = self.sessionSecrets(page)
             payload[search_switcher.name] = search_switcher.value
 
-            page = self.lxmlize(self.LEGISLATION_URL, payload)
+            page = self.freshPage(self.LEGISLATION_URL, payload)
 
             if 'simple search' not in page.xpath("//input[@id='ctl00_ContentPlaceHolder1_btnSwitch']")[0].value.lower():
                 raise ValueError('Not on the advanced search page')
@@ -215,6 +293,20 @@ def dateBound(creation_date):
 
 
 class LegistarAPIBillScraper(LegistarAPIScraper):
+    # The subresources that hydrate_matters fetches by default
+    HYDRATED_SUBRESOURCES = ('history',
+                             'sponsors',
+                             'attachments',
+                             'relations',
+                             'topics',
+                             'code_sections',
+                             'text')
+
+    # Matters' web detail URLs are looked up in batches of
+    # DETAIL_URL_BATCH, with DETAIL_URL_WORKERS requests at once
+    DETAIL_URL_BATCH = 100
+    DETAIL_URL_WORKERS = 4
+
     def __init__(self, *args, **kwargs):
         '''
         Initialize the Bill scraper with a `scrape_restricted` property.
@@ -225,7 +317,24 @@ class LegistarAPIBillScraper(LegistarAPIScraper):
 
         self.scrape_restricted = False
 
-    def matters(self, since_datetime=None):
+        # Set to a legistar.stores.DetailURLStore to remember matters'
+        # web detail URLs between scrapes
+        self.detail_url_store = None
+
+    def matters(self, since_datetime=None, fields=None):
+        '''
+        If the scraper has a state_store and no since_datetime is
+        given, scrape the matters modified since the last scrape.
+        '''
+        if since_datetime is None:
+            since_datetime = self.high_water_mark('matters')
+
+        yield from self.track_high_water_mark(
+            self._matters(since_datetime, fields),
+            'matters',
+            'MatterLastModifiedUtc')
+
+    def _matters(self, since_datetime, fields):
         # scrape from oldest to newest. This makes resuming big
         # scraping jobs easier because upon a scrape failure we can
         # import everything scraped and then scrape everything newer
@@ -233,16 +342,12 @@ class LegistarAPIBillScraper(LegistarAPIScraper):
         params = {'$orderby': 'MatterLastModifiedUtc'}
 
         if since_datetime:
-            since_iso = since_datetime.isoformat()
-
             update_fields = ('MatterLastModifiedUtc',
                              'MatterIntroDate',
                              'MatterPassedDate',
                              'MatterDate1',
                              'MatterDate2',
-                             # 'MatterEXDate1', # can't use all 17 search
-                                                # terms, this one always
-                                                # seems to be not set
+                             'MatterEXDate1',
                              'MatterEXDate2',
                              'MatterEXDate3',
                              'MatterEXDate4',
@@ -255,41 +360,125 @@ class LegistarAPIBillScraper(LegistarAPIScraper):
                              'MatterEnactmentDate',
                              'MatterAgendaDate')
 
-            since_fmt = "{field} gt datetime'{since_datetime}'"
-            since_filter =\
-                ' or '.join(since_fmt.format(field=field,
-                                             since_datetime=since_iso)
-                            for field in update_fields)
-
-            params['$filter'] = since_filter
+            # This is more terms than the API accepts in one query, so
+            # the pager will split it into several queries.
+            params['$filter'] = odata.Or(*(odata.Field(field).gt(since_datetime)
+                                           for field in update_fields))
 
         matters_url = self.BASE_URL + '/matters'
 
-        for matter in self.pages(matters_url,
-                                 params=params,
-                                 item_key="MatterId"):
-            try:
-                legistar_url = self.legislation_detail_url(matter['MatterId'])
+        if fields is not None and self.detail_url_store is not None:
+            # To tell whether a stored detail URL still holds
+            fields = list(fields) + ['MatterRestrictViewViaWeb']
 
-            except scrapelib.HTTPError as e:
-                if e.response.status_code > 403:
-                    raise
+        matters = self.pages(matters_url,
+                             params=params,
+                             item_key="MatterId",
+                             fields=fields)
 
-                url = matters_url + '/{}'.format(matter['MatterId'])
-                self.warning('Bill could not be found in web interface: {}'.format(url))
-                if not self.scrape_restricted:
-                    continue
+        while True:
+            batch = list(itertools.islice(matters, self.DETAIL_URL_BATCH))
+            if not batch:
+                break
 
-            else:
-                matter['legistar_url'] = legistar_url
+            detail_urls = self.legislation_detail_urls(
+                (matter['MatterId'] for matter in batch),
+                restricted={matter['MatterId'] for matter in batch
+                            if matter.get('MatterRestrictViewViaWeb')})
+
+            for matter in batch:
+                try:
+                    legistar_url = detail_urls[matter['MatterId']].result()
 
-            yield matter
+                except scrapelib.HTTPError as e:
+                    if e.response.status_code > 403:
+                        raise
+
+                    url = matters_url + '/{}'.format(matter['MatterId'])
+                    self.warning('Bill could not be found in web interface: {}'.format(url))
+                    if not self.scrape_restricted:
+                        continue
+
+                else:
+                    matter['legistar_url'] = legistar_url
+
+                yield matter
+
+    def hydrate_matters(self, matters, include=None, workers=4):
+        '''
+        Fetch the subresources of each matter, e.g. its history and
+        sponsors, on a pool of `workers` threads, and yield the matters,
+        in order, with each subresource added under its name, e.g.
+        matter['history'].
+
+        `include` lists the subresources to fetch, and defaults to
+        HYDRATED_SUBRESOURCES. A subresource that can't be fetched is
+        logged and its exception added to matter['hydration_errors'],
+        instead of interrupting the scrape.
+
+        If the scraper has a digest_store, matters that haven't changed,
+        subresources and all, since they were last hydrated are skipped.
+        '''
+        if include is None:
+            include = self.HYDRATED_SUBRESOURCES
+
+        def matter_id(matter):
+            if 'hydration_errors' in matter:
+                return None
+            return matter['MatterId']
+
+        yield from self.skip_unchanged(
+            self._hydrate_matters(matters, include, workers),
+            'matters:' + ','.join(include),
+            matter_id)
+
+    def _hydrate_matters(self, matters, include, workers):
+        def fetch(name, matter_id):
+            result = getattr(self, name)(matter_id)
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+            return result
+
+        def hydrate(matter, futures):
+            for name, future in futures.items():
+                try:
+                    matter[name] = future.result()
+                except Exception as e:
+                    self.warning('Could not get {0} for {1}/matters/{2}: {3}'.format(
+                        name, self.BASE_URL, matter['MatterId'], e))
+                    matter.setdefault('hydration_errors', {})[name] = e
+            return matter
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Only fetch subresources for a few matters ahead of the
+            # one we are waiting on
+            window = deque()
+
+            try:
+                for matter in matters:
+                    futures = {name: executor.submit(fetch, name, matter['MatterId'])
+                               for name in include}
+                    window.append((matter, futures))
+
+                    if len(window) >= workers:
+                        yield hydrate(*window.popleft())
+
+                while window:
+                    yield hydrate(*window.popleft())
+
+            finally:
+                # If we stop early, don't fetch what nobody will read
+                for _, futures in window:
+                    for future in futures.values():
+                        future.cancel()
 
     def matter(self, matter_id):
         matter = self.endpoint('/matters/{}', matter_id)
+        restricted = {matter_id} if matter.get('MatterRestrictViewViaWeb') else ()
 
         try:
-            legistar_url = self.legislation_detail_url(matter_id)
+            legistar_url = self.legislation_detail_urls(
+                [matter_id], restricted)[matter_id].result()
         except scrapelib.HTTPError as e:
             if e.response.status_code > 403:
                 raise
@@ -306,10 +495,9 @@ class LegistarAPIBillScraper(LegistarAPIScraper):
 
     def endpoint(self, route, *args):
         url = self.BASE_URL + route
-        response = self.get(url.format(*args))
-        return response.json()
+        return self.get_json(url.format(*args))
 
-    code_sections = partialmethod(endpoint, 'matters/{0}/codesections')
+    code_sections = partialmethod(endpoint, '/matters/{0}/codesections')
 
     def topics(self, *args, **kwargs):
         if args:
@@ -479,6 +667,53 @@ class LegistarAPIBillScraper(LegistarAPIScraper):
         if int(response.headers['Content-Length']) < 21052630:
             return response.json()
 
+    def legislation_detail_urls(self, matter_ids, restricted=()):
+        '''
+        Look up the web detail URLs of several matters at once. Returns
+        a dictionary of futures, keyed by matter id, whose results are
+        the values legislation_detail_url would return, or raise.
+
+        `restricted` holds the ids of matters the API says are
+        restricted, whose stored detail URLs are checked again.
+        '''
+        with ThreadPoolExecutor(max_workers=self.DETAIL_URL_WORKERS) as executor:
+            return {matter_id: executor.submit(self._stored_detail_url,
+                                               matter_id,
+                                               matter_id in restricted)
+                    for matter_id in matter_ids}
+
+    def _stored_detail_url(self, matter_id, restricted=False):
+        store = self.detail_url_store
+        if store is None:
+            return self.legislation_detail_url(matter_id)
+
+        try:
+            legistar_url = store.get(self.BASE_WEB_URL, matter_id)
+            if legistar_url is not None and restricted:
+                # The matter has been restricted since we stored its
+                # URL, so it may no longer be viewable on the web
+                raise KeyError(matter_id)
+        except KeyError:
+            try:
+                legistar_url = self.legislation_detail_url(matter_id)
+            except scrapelib.HTTPError as e:
+                if e.response.status_code == 403:
+                    store.set(self.BASE_WEB_URL, matter_id, None)
+                raise
+            else:
+                store.set(self.BASE_WEB_URL, matter_id, legistar_url)
+                return legistar_url
+
+        if legistar_url is None:
+            # Raise the same error as legislation_detail_url does for
+            # restricted matters
+            response = requests.Response()
+            response.url = self.BASE_WEB_URL + '/gateway.aspx?m=l&id={0}'.format(matter_id)
+            response.status_code = 403
+            raise scrapelib.HTTPError(response)
+
+        return legistar_url
+
     def legislation_detail_url(self, matter_id):
         gateway_url = self.BASE_WEB_URL + '/gateway.aspx?m=l&id={0}'.format(matter_id)
 
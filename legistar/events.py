@@ -1,14 +1,17 @@
 from abc import ABCMeta, abstractmethod
 import time
 import datetime
-from collections import deque
+import threading
+from collections import OrderedDict
 import esprima
 
 import pytz
 import icalendar
 import scrapelib
 
-from .base import LegistarScraper, LegistarAPIScraper
+from .base import (LegistarScraper, LegistarAPIScraper, Checkpoint, RecentSet,
+                   ordered_map)
+from . import odata
 
 
 class LegistarEventsScraper(LegistarScraper):
@@ -17,6 +20,9 @@ class LegistarEventsScraper(LegistarScraper):
         'https://metro.granicusideas.com/meetings.js?scope=past'
     )
 
+    # How many years of the calendar to scrape at once
+    YEAR_WORKERS = 1
+
     def __init__(self, *args, event_info_key='Meeting Details', **kwargs):
         super().__init__(*args, **kwargs)
         self.event_info_key = event_info_key
@@ -46,10 +52,15 @@ class LegistarEventsScraper(LegistarScraper):
 
         return self._ecomment_dict
 
-    def eventPages(self, since):
+    def eventPages(self, since, checkpoint=None):
+        if checkpoint is not None and checkpoint.resumable:
+            yield from self.pages(self.EVENTSPAGE, checkpoint=checkpoint)
+            return
 
-        page = self.lxmlize(self.EVENTSPAGE)
-        for page in self.eventSearch(page, since):
+        # Like should_cache_response, always get a fresh copy of the
+        # top level events page, rather than one from lxmlize's cache
+        page = self.freshPage(self.EVENTSPAGE)
+        for page in self.eventSearch(page, since, checkpoint):
             yield page
 
     def should_cache_response(self, response):
@@ -58,22 +69,22 @@ class LegistarEventsScraper(LegistarScraper):
         return (super().should_cache_response(response) and
                 response.url != self.EVENTSPAGE)
 
-    def eventSearch(self, page, since):
+    def eventSearch(self, page, since, checkpoint=None):
         payload = self.sessionSecrets(page)
 
         payload['ctl00_ContentPlaceHolder1_lstYears_ClientState'] = '{"value":"%s"}' % since
 
         payload['__EVENTTARGET'] = 'ctl00$ContentPlaceHolder1$lstYears'
 
-        return self.pages(self.EVENTSPAGE, payload)
+        return self.pages(self.EVENTSPAGE, payload, checkpoint)
 
-    def events(self, follow_links=True, since=None):
+    def events(self, follow_links=True, since=None, compact=False):
         # If an event is added to the the legistar system while we
         # are scraping, it will shift the list of events down and
         # we might revisit the same event. So, we keep track of
         # the last few events we've visited in order to
         # make sure we are not revisiting
-        scraped_events = deque([], maxlen=10)
+        scraped_events = RecentSet(self.DEDUP_WINDOW)
 
         current_year = self.now().year
 
@@ -87,39 +98,95 @@ class LegistarEventsScraper(LegistarScraper):
         else:
             since_year = 0
 
+        # If the scraper has a checkpoint_store, pick up where an
+        # earlier, unfinished, walk through the calendar left off
+        checkpoint = None
+        if self.checkpoint_store is not None:
+            checkpoint = self.checkpoint('events', self.EVENTSPAGE, since)
+
         # Anticipate events will be scheduled for the following year to avoid
         # missing upcoming events during scrapes near the end of the current
         # year.
-        for year in range(current_year + 1, since_year, -1):
-            no_events_in_year = True
-
-            for page in self.eventPages(year):
-                events_table = page.xpath("//div[@id='ctl00_ContentPlaceHolder1_MultiPageCalendar']//table[@class='rgMasterTable']")[0]
-                for event, _, _ in self.parseDataTable(events_table):
-                    ical_url = event['iCalendar']['url']
-                    if ical_url in scraped_events:
-                        continue
-                    else:
-                        scraped_events.append(ical_url)
+        first_year = current_year + 1
+        if checkpoint is not None:
+            first_year = checkpoint.state.get('year', first_year)
+
+        years = range(first_year, since_year, -1)
 
-                    if follow_links and type(event[self.event_info_key]) == dict:
-                        agenda = self.agenda(event[self.event_info_key]['url'])
+        with Checkpoint.walk(checkpoint):
+            for year, pages in self._eventYears(years, compact, checkpoint):
+                no_events_in_year = True
+
+                for rows in pages:
+                    events = []
+                    for event in rows:
+                        if scraped_events.add(event['iCalendar']['url']):
+                            events.append(event)
+
+                    if follow_links:
+                        events = self.withDetails(events, self.eventAgenda)
                     else:
-                        agenda = None
+                        events = ((event, None) for event in events)
+
+                    for event, agenda in events:
+                        yield event, agenda
+                        no_events_in_year = False
+                        if checkpoint is not None:
+                            checkpoint.emit()
+
+                # We scrape events in reverse chronological order, starting one year
+                # in the future. Stop scraping if there are no events in a given
+                # year, unless that year is in the future, because whether events
+                # have been scheduled in the future is not a reliable indication of
+                # whether any happened in the previous year.
+                if no_events_in_year and year <= current_year:
+                    break
+
+        if scraped_events.duplicates:
+            self.logger.info('Skipped {} duplicate events'.format(
+                scraped_events.duplicates))
+
+    def _eventYears(self, years, compact, checkpoint):
+        '''
+        Yield each year with the event rows of each page of its
+        calendar. With more than one YEAR_WORKERS, the calendars of
+        several years are scraped at once, each by a clone of the
+        scraper, and checkpoints only record the year.
+        '''
+        if self.YEAR_WORKERS <= 1:
+            for year in years:
+                if checkpoint is None:
+                    pages = self.eventPages(year)
+                else:
+                    checkpoint.save(year=year)
+                    pages = self.eventPages(year, checkpoint)
 
-                    yield event, agenda
-                    no_events_in_year = False
+                yield year, (self._eventRows(page, compact) for page in pages)
 
-            # We scrape events in reverse chronological order, starting one year
-            # in the future. Stop scraping if there are no events in a given
-            # year, unless that year is in the future, because whether events
-            # have been scheduled in the future is not a reliable indication of
-            # whether any happened in the previous year.
-            if no_events_in_year and year <= current_year:
-                break
+            return
+
+        def scrape_year(year):
+            scraper = self.clone()
+            return [scraper._eventRows(page, compact)
+                    for page in scraper.eventPages(year)]
+
+        for year, pages in ordered_map(scrape_year, years, self.YEAR_WORKERS):
+            if checkpoint is not None:
+                checkpoint.save(year=year)
+            yield year, pages
+
+    def _eventRows(self, page, compact):
+        events_table = page.xpath("//div[@id='ctl00_ContentPlaceHolder1_MultiPageCalendar']//table[@class='rgMasterTable']")[0]
+        return [event for event, _, _ in self.parseDataTable(events_table, compact)]
+
+    def eventAgenda(self, event):
+        if type(event[self.event_info_key]) != dict:
+            return None
+
+        return list(self.agenda(event[self.event_info_key]['url']))
 
     def agenda(self, detail_url):
-        page = self.lxmlize(detail_url)
+        page = self.freshPage(detail_url)
 
         payload = self.sessionSecrets(page)
 
@@ -175,10 +242,20 @@ class LegistarAPIEventScraperBase(LegistarAPIScraper, metaclass=ABCMeta):
     webscraper_class = LegistarEventsScraper
     WEB_RETRY_EVENTS = 3
 
+    # How many events' items and roll calls to keep for agenda, minutes,
+    # rollcalls and the digests of events
+    EVENT_ITEMS_CACHE_SIZE = 16
+
+    # How many items' roll calls to fetch at once
+    ROLLCALL_WORKERS = 4
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._webscraper = self._init_webscraper()
 
+        self._event_cache = OrderedDict()
+        self._event_cache_lock = threading.Lock()
+
     def _init_webscraper(self):
         webscraper = self.webscraper_class(
             requests_per_minute=self.requests_per_minute,
@@ -197,11 +274,32 @@ class LegistarAPIEventScraperBase(LegistarAPIScraper, metaclass=ABCMeta):
 
         return webscraper
 
+    @LegistarAPIScraper.rate_limiter.setter
+    def rate_limiter(self, rate_limiter):
+        LegistarAPIScraper.rate_limiter.fset(self, rate_limiter)
+
+        # Share the rate limiter with our web scraper, so that all our
+        # requests to a host are limited together
+        self._webscraper.rate_limiter = rate_limiter
+
     @abstractmethod
     def _get_web_event(self, api_event):
         pass
 
-    def api_events(self, since_datetime=None):
+    def api_events(self, since_datetime=None, fields=None):
+        '''
+        If the scraper has a state_store and no since_datetime is
+        given, scrape the events modified since the last scrape.
+        '''
+        if since_datetime is None:
+            since_datetime = self.high_water_mark('events')
+
+        yield from self.track_high_water_mark(
+            self._api_events(since_datetime, fields),
+            'events',
+            'EventLastModifiedUtc')
+
+    def _api_events(self, since_datetime, fields):
         # scrape from oldest to newest. This makes resuming big
         # scraping jobs easier because upon a scrape failure we can
         # import everything scraped and then scrape everything newer
@@ -213,7 +311,7 @@ class LegistarAPIEventScraperBase(LegistarAPIScraper, metaclass=ABCMeta):
             # to make sure we grab updated fields (e.g. audio recordings)
             # that don't update the last modified timestamp.
             backwards_window = datetime.timedelta(hours=72)
-            since_iso = (since_datetime - backwards_window).isoformat()
+            since = since_datetime - backwards_window
 
             # Minutes are often published after an event occurs – without a
             # corresponding event modification. Query all update fields so later
@@ -224,21 +322,35 @@ class LegistarAPIEventScraperBase(LegistarAPIScraper, metaclass=ABCMeta):
                              'EventAgendaLastPublishedUTC',
                              'EventMinutesLastPublishedUTC')
 
-            since_fmt = "{field} gt datetime'{since_datetime}'"
-            since_filter =\
-                ' or '.join(since_fmt.format(field=field,
-                                             since_datetime=since_iso)
-                            for field in update_fields)
-
-            params['$filter'] = since_filter
+            params['$filter'] = odata.Or(*(odata.Field(field).gt(since)
+                                           for field in update_fields))
 
         events_url = self.BASE_URL + '/events/'
 
         yield from self.pages(events_url,
                               params=params,
-                              item_key="EventId")
+                              item_key="EventId",
+                              fields=fields)
 
     def events(self, since_datetime=None):
+        '''
+        If the scraper has a digest_store, events that haven't changed
+        since they were last scraped, on the API or the web, or in
+        their items or roll calls, are skipped.
+        '''
+        def hydrated(event):
+            api_event, web_event = event
+            return {'api_event': api_event,
+                    'web_event': web_event,
+                    'items': self.event_items(api_event),
+                    'rollcalls': list(self.rollcalls(api_event))}
+
+        yield from self.skip_unchanged(self._events(since_datetime),
+                                       'events',
+                                       lambda event: event[0]['EventId'],
+                                       hydrated)
+
+    def _events(self, since_datetime):
         for api_event in self.api_events(since_datetime=since_datetime):
             if event := self.event(api_event):
                 yield event
@@ -279,15 +391,45 @@ class LegistarAPIEventScraperBase(LegistarAPIScraper, metaclass=ABCMeta):
                 "API event could not be found in web interface: {0}".format(event_url)
             )
 
+    def event_items(self, event):
+        '''
+        The items of an event. agenda, minutes and rollcalls all need
+        them, so the items of the last few events are kept.
+        '''
+        def fetch():
+            items_url = (self.BASE_URL +
+                         '/events/{}/eventitems'.format(event['EventId']))
+            return self.get_json(items_url)
+
+        # Copies, so that changes to an item don't leak into other
+        # methods' items
+        return [dict(item) for item in self._event_cached('items', event, fetch)]
+
+    def _event_cached(self, kind, event, fetch):
+        key = (kind, event['EventId'])
+
+        with self._event_cache_lock:
+            value = self._event_cache.get(key)
+            if value is not None:
+                self._event_cache.move_to_end(key)
+
+        if value is None:
+            value = fetch()
+
+            with self._event_cache_lock:
+                self._event_cache[key] = value
+                while len(self._event_cache) > 2 * self.EVENT_ITEMS_CACHE_SIZE:
+                    self._event_cache.popitem(last=False)
+
+        return value
+
     def agenda(self, event):
         agenda_url = (self.BASE_URL +
                       '/events/{}/eventitems'.format(event['EventId']))
 
-        response = self.get(agenda_url)
-
         # If an event item does not have a value for
         # EventItemAgendaSequence, it is not on the agenda
-        filtered_items = (item for item in response.json()
+        filtered_items = (item for item in self.event_items(event)
                           if (item['EventItemTitle'] and
                               item['EventItemAgendaSequence']))
         sorted_items = sorted(filtered_items,
@@ -301,11 +443,9 @@ class LegistarAPIEventScraperBase(LegistarAPIScraper, metaclass=ABCMeta):
         minutes_url = (self.BASE_URL +
                        '/events/{}/eventitems'.format(event['EventId']))
 
-        response = self.get(minutes_url)
-
         # If an event item does not have a value for
         # EventItemMinutesSequence, it is not in the minutes
-        filtered_items = (item for item in response.json()
+        filtered_items = (item for item in self.event_items(event)
                           if (item['EventItemTitle'] and
                               item['EventItemMinutesSequence']))
         sorted_items = sorted(filtered_items,
@@ -335,15 +475,26 @@ class LegistarAPIEventScraperBase(LegistarAPIScraper, metaclass=ABCMeta):
         pass
 
     def rollcalls(self, event):
-        for item in self.agenda(event):
-            if item['EventItemRollCallFlag']:
-                rollcall_url = self.BASE_URL + \
-                    '/eventitems/{}/rollcalls'.format(item['EventItemId'])
+        '''
+        The roll calls of an event's items. Like the items, the roll
+        calls of the last few events are kept.
+        '''
+        def item_rollcalls(item):
+            rollcall_url = self.BASE_URL + \
+                '/eventitems/{}/rollcalls'.format(item['EventItemId'])
+            return self.get_json(rollcall_url)
+
+        def fetch():
+            items = [item for item in self.agenda(event)
+                     if item['EventItemRollCallFlag']]
 
-                response = self.get(rollcall_url)
+            return [rollcall
+                    for _, rollcalls in ordered_map(item_rollcalls, items,
+                                                    self.ROLLCALL_WORKERS)
+                    for rollcall in rollcalls]
 
-                for item in response.json():
-                    yield item
+        for rollcall in self._event_cached('rollcalls', event, fetch):
+            yield dict(rollcall)
 
     def addDocs(self, e, events, doc_type):
         try:
@@ -411,18 +562,37 @@ class LegistarAPIEventScraperZip(LegistarAPIEventScraperBase):
     event listing page, like NYC's 'Meeting Topic.' This scraper visits
     the listing page and attempts to zip API and web events together
     '''
+    # How many iCalendar files to download at once, for events whose
+    # start time isn't clear from the calendar
+    ICAL_WORKERS = 4
+
+    # How far apart the start times of an API event and the web event
+    # it is matched with can be
+    EVENT_TIME_TOLERANCE = datetime.timedelta(0)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # Set to a legistar.stores.EventTimeStore to remember the start
+        # times from iCalendar files between scrapes
+        self.event_time_store = None
+
         # Set attribute equal to an instance of our generator yielding events
         # scraped from the Legistar web interface. This allows us to pause
         # and resume iteration as needed.
         self._events = self._scrapeWebCalendar()
 
-        # Instantiate dictionary where events from generator are stored as they
-        # are scraped.
+        # Index of the events from the generator, by normalized body name
+        # and then by date, as they are scraped.
         self._scraped_events = {}
 
+        # The start of the earliest event scraped so far
+        self._scraped_until = None
+
+        # There is one walk through the web calendar, so API events are
+        # looked up in it one at a time, e.g. by the async wrapper
+        self._web_results_lock = threading.Lock()
+
     def _get_web_event(self, api_event):
         if self._not_in_web_interface(api_event):
             return None
@@ -431,29 +601,93 @@ class LegistarAPIEventScraperZip(LegistarAPIEventScraperBase):
             return self.web_results(api_event)
 
     def web_results(self, event):
-        api_key = (event['EventBodyName'].strip(),
-                   event['start'])
+        name = self._normalize_body_name(event['EventBodyName'])
+        start = event['start']
+
+        with self._web_results_lock:
+            # If the API event isn't in the index of events we've already
+            # scraped from the web interface, or a closer match might be
+            # further along, continue scraping the web interface.
+            while not self._found_closest(name, start):
+                try:
+                    (web_name, web_start), web_event = next(self._events)
+                except StopIteration:
+                    break
+
+                self._index_web_event(self._normalize_body_name(web_name),
+                                      web_start,
+                                      web_event)
+
+            return self._indexed_web_event(name, start)
+
+    def _found_closest(self, name, start):
+        '''Whether the closest web event to an API event, if there is
+        one, must already be in the index
+        '''
+        closest = self._closest_web_event(name, start)
+        if closest is not None and not closest[0]:
+            return True
+
+        # The calendar is sorted by date, newest first, though not
+        # always by time within a day. So once we are past the earliest
+        # day a match could start on, no event still to come can match,
+        # or be closer than a match we have.
+        return (self._scraped_until is not None and
+                self._scraped_until.date() < (start - self.EVENT_TIME_TOLERANCE).date())
+
+    def _normalize_body_name(self, name):
+        '''Body names in the API and the web interface can differ in case
+        and spacing. Available for override in jurisdictional scrapers.
+        '''
+        return ' '.join(name.split()).casefold()
 
-        # Check the cache of events we've already scraped from the web interface
-        # for the API event at hand.
-        if api_key in self._scraped_events:
-            return self._scraped_events[api_key]
+    def _index_web_event(self, name, start, web_event):
+        days = self._scraped_events.setdefault(name, {})
+        days.setdefault(start.date(), []).append((start, web_event))
 
-        else:
-            # If API event not in web scrape cache, continue scraping the web
-            # interface.
-            for web_key, event in self._events:
-                self._scraped_events[web_key] = event
-                # When we find the API event, stop scraping.
-                if web_key == api_key:
-                    return event
+        if self._scraped_until is None or start < self._scraped_until:
+            self._scraped_until = start
+
+    def _indexed_web_event(self, name, start):
+        '''The scraped web event of a body that starts closest to start,
+        within EVENT_TIME_TOLERANCE, or None
+        '''
+        closest = self._closest_web_event(name, start)
+        if closest is not None:
+            return closest[1]
+
+    def _closest_web_event(self, name, start):
+        days = self._scraped_events.get(name)
+        if not days:
+            return None
+
+        tolerance = self.EVENT_TIME_TOLERANCE
+        candidates = []
+
+        day = (start - tolerance).date()
+        while day <= (start + tolerance).date():
+            for web_start, web_event in days.get(day, ()):
+                if abs(web_start - start) <= tolerance:
+                    candidates.append((abs(web_start - start), web_event))
+            day += datetime.timedelta(days=1)
+
+        if candidates:
+            return min(candidates, key=lambda candidate: candidate[0])
 
     def _scrapeWebCalendar(self):
-        '''Generator yielding events from Legistar in roughly reverse
-        chronological order.
+        '''Generator yielding events from Legistar in reverse
+        chronological order of their dates.
         '''
-        for event, _ in self._webscraper.events(follow_links=False):
-            event_key = self._event_key(event, self._webscraper)
+        events = (event for event, _ in self._webscraper.events(follow_links=False))
+
+        # Keying an event may mean downloading its iCalendar file, so
+        # key a few events at once
+        keyed_events = ordered_map(
+            lambda event: self._event_key(event, self._webscraper),
+            events,
+            self.ICAL_WORKERS)
+
+        for event, event_key in keyed_events:
             yield event_key, event
 
     def _event_key(self, event, web_scraper):
@@ -463,15 +697,52 @@ class LegistarAPIEventScraperZip(LegistarAPIEventScraperBase):
         uniquely identify every event and will allow us to link
         events from the two data sources.
         '''
-        response = web_scraper.get(event['iCalendar']['url'], verify=False)
-        event_time = web_scraper.ical(response.text).subcomponents[0]['DTSTART'].dt
+        event_time = self._calendar_time(event)
+        if event_time is None:
+            event_time = self._ical_time(event['iCalendar']['url'], web_scraper)
+
         event_time = pytz.timezone(self.TIMEZONE).localize(event_time)
 
-        key = (event['Name']['label'],
+        name = event['Name']
+        if isinstance(name, dict):
+            name = name['label']
+
+        key = (name,
                event_time)
 
         return key
 
+    def _calendar_time(self, event):
+        '''The start time of an event, from the Meeting Date and Meeting
+        Time columns of the calendar, or None if they don't give a time,
+        e.g. because the meeting time is "TBD".
+        '''
+        date = event.get('Meeting Date')
+        time = event.get('Meeting Time')
+        if not isinstance(date, str) or not isinstance(time, str):
+            return None
+
+        try:
+            return datetime.datetime.strptime(
+                '{} {}'.format(date.strip(), ' '.join(time.split())),
+                '%m/%d/%Y %I:%M %p')
+        except ValueError:
+            return None
+
+    def _ical_time(self, ical_url, web_scraper):
+        if self.event_time_store is not None:
+            event_time = self.event_time_store.get(ical_url)
+            if event_time is not None:
+                return event_time
+
+        response = web_scraper.get(ical_url, verify=False)
+        event_time = web_scraper.ical(response.text).subcomponents[0]['DTSTART'].dt
+
+        if self.event_time_store is not None:
+            self.event_time_store.set(ical_url, event_time)
+
+        return event_time
+
     def _not_in_web_interface(self, event):
         '''Occasionally, an event will appear in the API, but not in the web
         interface. This method checks attributes of the API event that tell us
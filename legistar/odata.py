@@ -0,0 +1,165 @@
+'''
+A small builder for the OData $filter expressions that the Legistar
+API accepts, e.g.
+
+    Field('MatterIntroDate').gt(datetime.date(2017, 1, 1)) | \
+        Field('MatterPassedDate').gt(datetime.date(2017, 1, 1))
+
+The API rejects filters with too many terms, so filters can be split
+into several smaller filters whose results, taken together, are the
+same as the results of the original filter.
+'''
+import datetime
+import re
+
+
+DATETIME = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?')
+
+
+def literal(value):
+    '''
+    Format a value from an API response, or a Python date or
+    datetime, as an OData literal.
+    '''
+    if value is None:
+        return 'null'
+    elif isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, (int, float)):
+        return str(value)
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        return "datetime'{}'".format(value.isoformat())
+    elif DATETIME.fullmatch(value):
+        return "datetime'{}'".format(value)
+    else:
+        return "'{}'".format(value.replace("'", "''"))
+
+
+class Filter(object):
+    terms = 1
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def split(self, max_terms):
+        '''
+        Return a list of filters with no more than max_terms terms
+        each, whose results, together, match the results of this
+        filter.
+        '''
+        return [self]
+
+
+class Comparison(Filter):
+    def __init__(self, field, operator, value):
+        self.field = field
+        self.operator = operator
+        self.value = value
+
+    def __str__(self):
+        return '{} {} {}'.format(self.field, self.operator, literal(self.value))
+
+
+class Field(object):
+    def __init__(self, name):
+        self.name = name
+
+    def eq(self, value):
+        return Comparison(self.name, 'eq', value)
+
+    def ne(self, value):
+        return Comparison(self.name, 'ne', value)
+
+    def gt(self, value):
+        return Comparison(self.name, 'gt', value)
+
+    def ge(self, value):
+        return Comparison(self.name, 'ge', value)
+
+    def lt(self, value):
+        return Comparison(self.name, 'lt', value)
+
+    def le(self, value):
+        return Comparison(self.name, 'le', value)
+
+
+class _Compound(Filter):
+    operator = None
+
+    def __init__(self, *filters):
+        self.filters = filters
+
+    @property
+    def terms(self):
+        return sum(f.terms for f in self.filters)
+
+    def __str__(self):
+        operator = ' {} '.format(self.operator)
+        return operator.join('({})'.format(f) if isinstance(f, _Compound) else str(f)
+                             for f in self.filters)
+
+
+class Or(_Compound):
+    operator = 'or'
+
+    def split(self, max_terms):
+        if self.terms <= max_terms:
+            return [self]
+
+        # Pack the alternatives into as few filters as will fit
+        parts = []
+        for f in self.filters:
+            for part in f.split(max_terms):
+                if parts and parts[-1].terms + part.terms <= max_terms:
+                    parts[-1] = Or(*parts[-1].filters, part)
+                else:
+                    parts.append(Or(part))
+
+        return [part.filters[0] if len(part.filters) == 1 else part
+                for part in parts]
+
+
+class And(_Compound):
+    operator = 'and'
+
+    def split(self, max_terms):
+        if self.terms <= max_terms:
+            return [self]
+
+        # (a and (b or c)) is the same as ((a and b) or (a and c)),
+        # so split the largest of the conditions, and keep the rest
+        # in every part.
+        largest = max(self.filters, key=lambda f: f.terms)
+        rest = [f for f in self.filters if f is not largest]
+        budget = max_terms - sum(f.terms for f in rest)
+
+        parts = largest.split(budget) if budget > 0 else [largest]
+        if len(parts) == 1:
+            raise ValueError('Cannot split {} into filters of at most {} '
+                             'terms'.format(self, max_terms))
+
+        return [f for part in parts for f in And(*rest, part).split(max_terms)]
+
+
+def keyset(order_field, order_value, item_key, item_id):
+    '''
+    A filter for the items that sort after an item with the given
+    $orderby field value and item_key id, when sorting by the $orderby
+    field and then by item_key.
+    '''
+    key = Field(item_key)
+
+    if order_field == item_key:
+        return key.gt(item_id)
+
+    field = Field(order_field)
+
+    # Nulls sort first, so everything that has a value comes after
+    # an item without one.
+    if order_value is None:
+        return (field.eq(None) & key.gt(item_id)) | field.ne(None)
+
+    return field.gt(order_value) | (field.eq(order_value) & key.gt(item_id))
@@ -1,4 +1,6 @@
-from .base import LegistarScraper, LegistarAPIScraper
+import json
+
+from .base import LegistarScraper, LegistarAPIScraper, Checkpoint
 
 
 class LegistarPersonScraper(LegistarScraper):
@@ -6,43 +8,60 @@ class LegistarPersonScraper(LegistarScraper):
     ALL_MEMBERS = None
 
     def councilMembers(self, extra_args=None, follow_links=True):
+        # If the scraper has a checkpoint_store, pick up where an
+        # earlier, unfinished, walk through the members left off
+        checkpoint = None
+        if self.checkpoint_store is not None:
+            checkpoint = self.checkpoint('councilMembers', self.MEMBERLIST,
+                                         json.dumps(extra_args, sort_keys=True))
+
         payload = {}
-        if extra_args:
+        if extra_args and not (checkpoint and checkpoint.resumable):
             payload.update(extra_args)
-            page = self.lxmlize(self.MEMBERLIST, payload)
+            page = self.freshPage(self.MEMBERLIST, payload)
             payload.update(self.sessionSecrets(page))
 
         if self.ALL_MEMBERS:
             payload['__EVENTTARGET'] = "ctl00$ContentPlaceHolder1$menuPeople"
             payload['__EVENTARGUMENT'] = self.ALL_MEMBERS
 
-        for page in self.pages(self.MEMBERLIST, payload):
-            table = page.xpath(
-                "//table[@id='ctl00_ContentPlaceHolder1_gridPeople_ctl00']")[0]
+        with Checkpoint.walk(checkpoint):
+            for page in self.pages(self.MEMBERLIST, payload, checkpoint):
+                table = page.xpath(
+                    "//table[@id='ctl00_ContentPlaceHolder1_gridPeople_ctl00']")[0]
+
+                rows = (councilman for councilman, _, _ in self.parseDataTable(table))
+
+                if follow_links:
+                    rows = self.withDetails(rows, self.councilMemberDetails)
+                    rows = (details or councilman for councilman, details in rows)
 
-            for councilman, headers, row in self.parseDataTable(table):
-                if follow_links and type(councilman['Person Name']) == dict:
+                for row in rows:
+                    yield row
+                    if checkpoint is not None:
+                        checkpoint.emit()
 
-                    detail_url = councilman['Person Name']['url']
-                    councilman_details = self.lxmlize(detail_url)
-                    detail_div = councilman_details.xpath(
-                        ".//div[@id='ctl00_ContentPlaceHolder1_pageDetails']")[0]
+    def councilMemberDetails(self, councilman):
+        if type(councilman['Person Name']) != dict:
+            return None
 
-                    councilman.update(self.parseDetails(detail_div))
+        detail_url = councilman['Person Name']['url']
+        councilman_details = self.lxmlize(detail_url)
+        detail_div = councilman_details.xpath(
+            ".//div[@id='ctl00_ContentPlaceHolder1_pageDetails']")[0]
 
-                    img = councilman_details.xpath(
-                        "//img[@id='ctl00_ContentPlaceHolder1_imgPhoto']")
-                    if img:
-                        councilman['Photo'] = img[0].get('src')
+        councilman.update(self.parseDetails(detail_div))
 
-                    committee_table = councilman_details.xpath(
-                        "//table[@id='ctl00_ContentPlaceHolder1_gridDepartments_ctl00']")[0]
-                    committees = self.parseDataTable(committee_table)
+        img = councilman_details.xpath(
+            "//img[@id='ctl00_ContentPlaceHolder1_imgPhoto']")
+        if img:
+            councilman['Photo'] = img[0].get('src')
 
-                    yield councilman, committees
+        committee_table = councilman_details.xpath(
+            "//table[@id='ctl00_ContentPlaceHolder1_gridDepartments_ctl00']")[0]
+        committees = self.parseDataTable(committee_table)
 
-                else:
-                    yield councilman
+        return councilman, committees
 
 
 class LegistarAPIPersonScraper(LegistarAPIScraper):
@@ -57,10 +76,10 @@ class LegistarAPIPersonScraper(LegistarAPIScraper):
 
         return types
 
-    def bodies(self):
+    def bodies(self, fields=None):
         bodies_url = self.BASE_URL + '/bodies/'
 
-        for body in self.pages(bodies_url, item_key="BodyId"):
+        for body in self.pages(bodies_url, item_key="BodyId", fields=fields):
             yield body
 
     def body_offices(self, body):
@@ -0,0 +1,129 @@
+'''
+A rate limiter that can be shared by every scraper in a process, e.g.
+an API scraper and the web scraper it uses for InSite pages.
+
+Each host gets its own token bucket. A bucket slows down whenever the
+host returns a server error, and speeds up again, a little at a time,
+after a run of successful requests, so that we scrape as quickly as
+the host allows.
+'''
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+
+class _Bucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.successes = 0
+
+
+class RateLimiter(object):
+    def __init__(self,
+                 requests_per_minute=60,
+                 min_requests_per_minute=6,
+                 max_requests_per_minute=None,
+                 burst=1,
+                 speed_up_after=20):
+        if max_requests_per_minute is None:
+            max_requests_per_minute = requests_per_minute * 4
+
+        self.rate = requests_per_minute / 60
+        self.min_rate = min_requests_per_minute / 60
+        self.max_rate = max_requests_per_minute / 60
+        self.burst = burst
+        self.speed_up_after = speed_up_after
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._buckets:
+            self._buckets[host] = _Bucket(self.rate, self.burst)
+        return self._buckets[host]
+
+    def requests_per_minute(self, url):
+        with self._lock:
+            return self._bucket(url).rate * 60
+
+    def wait(self, url):
+        '''
+        Block until we may send a request to the host of the url.
+        '''
+        with self._lock:
+            bucket = self._bucket(url)
+
+            now = time.monotonic()
+            bucket.tokens = min(bucket.burst,
+                                bucket.tokens + (now - bucket.updated) * bucket.rate)
+            bucket.updated = now
+
+            # Take a token, even if we have to wait for it, so that
+            # waiting threads are served in turn
+            bucket.tokens -= 1
+            delay = -bucket.tokens / bucket.rate if bucket.tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+    def success(self, url):
+        with self._lock:
+            bucket = self._bucket(url)
+            bucket.successes += 1
+
+            if bucket.successes >= self.speed_up_after:
+                bucket.rate = min(self.max_rate, bucket.rate + self.rate / 10)
+                bucket.successes = 0
+
+    def failure(self, url):
+        with self._lock:
+            bucket = self._bucket(url)
+            bucket.rate = max(self.min_rate, bucket.rate / 2)
+            bucket.successes = 0
+
+
+class RateLimitedSession(requests.Session):
+    '''
+    Waits on the rate_limiter, if there is one, before every request,
+    including retries, and tells it how the request went.
+    '''
+    @property
+    def rate_limiter(self):
+        return getattr(self, '_rate_limiter', None)
+
+    @rate_limiter.setter
+    def rate_limiter(self, rate_limiter):
+        self._rate_limiter = rate_limiter
+        if rate_limiter is not None:
+            # The rate limiter takes over from scrapelib's throttle
+            self.requests_per_minute = 0
+
+    def request(self, method, url, **kwargs):
+        rate_limiter = self.rate_limiter
+        if rate_limiter is None:
+            return super().request(method, url, **kwargs)
+
+        rate_limiter.wait(url)
+
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code >= 500:
+                rate_limiter.failure(url)
+            raise
+        except (requests.ConnectionError, requests.Timeout):
+            rate_limiter.failure(url)
+            raise
+
+        if response.status_code >= 500 or response.status_code == 429:
+            rate_limiter.failure(url)
+        else:
+            rate_limiter.success(url)
+
+        return response
@@ -0,0 +1,248 @@
+'''
+Small, persistent stores that let scrapers skip work they have done
+in earlier runs. Each store is a SQLite database, so a store can be
+shared by scrapers running in different processes.
+'''
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+
+class SQLiteStore(object):
+    schema = None
+
+    def __init__(self, path):
+        self.path = path
+        # Scrapers may use a store from several threads at once, so we
+        # share one connection and serialize access to it ourselves.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._connection:
+            self._connection.executescript(self.schema)
+
+    def _execute(self, sql, parameters=()):
+        with self._lock, self._connection:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def close(self):
+        self._connection.close()
+
+
+class ResponseCache(SQLiteStore):
+    '''
+    Stores API response bodies along with their ETag and Last-Modified
+    validators, so that they can be revalidated with a conditional GET.
+    Responses without validators are reused for `ttl` seconds.
+    '''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            stored_at REAL,
+            body TEXT
+        );
+    '''
+
+    def __init__(self, path, ttl=3600):
+        super().__init__(path)
+        self.ttl = ttl
+
+    def get(self, url):
+        '''
+        Returns (etag, last_modified, age in seconds, body) for a url,
+        or None if the url is not in the cache.
+        '''
+        rows = self._execute(
+            'SELECT etag, last_modified, stored_at, body FROM responses '
+            'WHERE url = ?', (url,))
+
+        if rows:
+            etag, last_modified, stored_at, body = rows[0]
+            return etag, last_modified, time.time() - stored_at, body
+
+    def set(self, url, etag, last_modified, body):
+        self._execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+            (url, etag, last_modified, time.time(), body))
+
+    def touch(self, url):
+        self._execute('UPDATE responses SET stored_at = ? WHERE url = ?',
+                      (time.time(), url))
+
+
+class DetailURLStore(SQLiteStore):
+    '''
+    Remembers the web detail URL of each matter, or that the matter is
+    restricted, i.e. not viewable on the web. A matter's detail URL
+    doesn't change, but restricted matters can be made public, so
+    restricted matters are checked again after `restricted_ttl`
+    seconds.
+    '''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS detail_urls (
+            base_url TEXT,
+            matter_id INTEGER,
+            url TEXT,
+            checked_at REAL,
+            PRIMARY KEY (base_url, matter_id)
+        );
+    '''
+
+    def __init__(self, path, restricted_ttl=24 * 60 * 60):
+        super().__init__(path)
+        self.restricted_ttl = restricted_ttl
+
+    def get(self, base_url, matter_id):
+        '''
+        Returns the detail URL of a matter, or None if the matter is
+        restricted. Raises a KeyError if we don't know, or it is time
+        to check again.
+        '''
+        rows = self._execute(
+            'SELECT url, checked_at FROM detail_urls '
+            'WHERE base_url = ? AND matter_id = ?', (base_url, matter_id))
+
+        if rows:
+            url, checked_at = rows[0]
+            if url is not None or time.time() - checked_at < self.restricted_ttl:
+                return url
+
+        raise KeyError(matter_id)
+
+    def set(self, base_url, matter_id, url):
+        self._execute(
+            'INSERT OR REPLACE INTO detail_urls VALUES (?, ?, ?, ?)',
+            (base_url, matter_id, url, time.time()))
+
+
+class CheckpointStore(SQLiteStore):
+    '''
+    Saves where a walk through the pages of a grid got to, so that a
+    scraper can pick the walk up again in a new process. See
+    legistar.base.Checkpoint.
+    '''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            saved_at REAL
+        );
+    '''
+
+    def get(self, key):
+        rows = self._execute('SELECT state FROM checkpoints WHERE key = ?',
+                             (key,))
+        if rows:
+            return json.loads(rows[0][0])
+
+    def set(self, key, state):
+        self._execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)',
+                      (key, json.dumps(state), time.time()))
+
+    def delete(self, key):
+        self._execute('DELETE FROM checkpoints WHERE key = ?', (key,))
+
+
+class StateStore(SQLiteStore):
+    '''
+    Remembers, for each jurisdiction and resource, e.g. 'matters', the
+    last modified time of the newest record an incremental scrape has
+    finished with, so that the next scrape can start from there.
+    Times are naive UTC datetimes, like the API's *LastModifiedUtc
+    fields.
+    '''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS high_water_marks (
+            base_url TEXT,
+            resource TEXT,
+            last_modified TEXT,
+            PRIMARY KEY (base_url, resource)
+        );
+    '''
+
+    def get(self, base_url, resource):
+        '''
+        Returns the high water mark of a resource, or None if we have
+        not scraped it yet.
+        '''
+        rows = self._execute(
+            'SELECT last_modified FROM high_water_marks '
+            'WHERE base_url = ? AND resource = ?', (base_url, resource))
+
+        if rows:
+            seconds, _, fraction = rows[0][0].partition('.')
+            last_modified = datetime.datetime.strptime(seconds,
+                                                       '%Y-%m-%dT%H:%M:%S')
+            if fraction:
+                microseconds = int(fraction[:6].ljust(6, '0'))
+                last_modified = last_modified.replace(microsecond=microseconds)
+            return last_modified
+
+    def set(self, base_url, resource, last_modified):
+        '''
+        last_modified is a naive UTC datetime or a time from the API,
+        e.g. '2019-02-12T16:23:41.39'
+        '''
+        if isinstance(last_modified, datetime.datetime):
+            last_modified = last_modified.isoformat()
+
+        self._execute(
+            'INSERT OR REPLACE INTO high_water_marks VALUES (?, ?, ?)',
+            (base_url, resource, last_modified))
+
+
+class DigestStore(SQLiteStore):
+    '''
+    Remembers a digest of each record a scraper has yielded, so that
+    the scraper can skip records that haven't changed.
+    '''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS digests (
+            base_url TEXT,
+            resource TEXT,
+            record_id TEXT,
+            digest TEXT,
+            PRIMARY KEY (base_url, resource, record_id)
+        );
+    '''
+
+    def get(self, base_url, resource, record_id):
+        rows = self._execute(
+            'SELECT digest FROM digests '
+            'WHERE base_url = ? AND resource = ? AND record_id = ?',
+            (base_url, resource, str(record_id)))
+
+        if rows:
+            return rows[0][0]
+
+    def set(self, base_url, resource, record_id, digest):
+        self._execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)',
+                      (base_url, resource, str(record_id), digest))
+
+
+class EventTimeStore(SQLiteStore):
+    '''
+    Remembers the start time of each event, as given by its iCalendar
+    file, so that the file only has to be downloaded once. Times are
+    naive local times, as in the files.
+    '''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS event_times (
+            ical_url TEXT PRIMARY KEY,
+            start TEXT
+        );
+    '''
+
+    def get(self, ical_url):
+        rows = self._execute('SELECT start FROM event_times WHERE ical_url = ?',
+                             (ical_url,))
+        if rows:
+            return datetime.datetime.strptime(rows[0][0], '%Y-%m-%dT%H:%M:%S')
+
+    def set(self, ical_url, start):
+        self._execute('INSERT OR REPLACE INTO event_times VALUES (?, ?)',
+                      (ical_url, start.strftime('%Y-%m-%dT%H:%M:%S')))
@@ -0,0 +1,125 @@
+'''
+Micro-benchmarks for the scrapers, run against the test fixtures
+and mocked API responses rather than live Legistar sites.
+
+    python tests/benchmark.py
+'''
+import json
+import os
+import re
+import time
+import tracemalloc
+
+import lxml.html
+import requests_mock
+
+from legistar.base import LegistarAPIScraper, LegistarScraper
+
+
+FIXTURES = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'fixtures')
+
+
+def measure(label, func, repeat=3):
+    '''
+    Run func a few times and print the best wall clock time and the
+    peak memory allocated during a run.
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('{:<40} {:>8.1f} ms {:>10.1f} KiB'.format(
+        label, min(timings) * 1000, peak / 1024))
+
+
+def api_page(page_size=1000):
+    with open(os.path.join(FIXTURES, 'chicago', 'no_dupe_event.json')) as f:
+        items = json.load(f)
+
+    page = []
+    while len(page) < page_size:
+        for item in items:
+            page.append(dict(item, MatterHistoryId=len(page)))
+    return json.dumps(page[:page_size])
+
+
+def benchmark_api_pages(n_pages=5):
+    scraper = LegistarAPIScraper(requests_per_minute=0)
+    scraper.BASE_URL = 'https://webapi.legistar.com/v1/chicago'
+    url = scraper.BASE_URL + '/matters/1/histories'
+
+    full_page = api_page()
+    last_page = api_page(500)
+
+    def callback(request, context):
+        skip = int(request.qs['$skip'][0])
+        return full_page if skip < (n_pages - 1) * 1000 else last_page
+
+    def double_decode():
+        # How pages() read the API before each page was decoded once
+        page_num = 0
+        response = None
+        while page_num == 0 or len(response.json()) == 1000:
+            response = scraper.get(url, params={'$skip': page_num * 1000})
+            for item in response.json():
+                pass
+            page_num += 1
+
+    def consume(stream):
+        def run():
+            for item in scraper.pages(url, item_key='MatterHistoryId',
+                                      stream=stream):
+                pass
+        return run
+
+    print('API pager, {} pages'.format(n_pages))
+    with requests_mock.Mocker() as m:
+        m.get(re.compile('/histories'), text=callback)
+
+        measure('  decode each page twice', double_decode)
+        measure('  decode each page once', consume(stream=False))
+        measure('  decode incrementally (stream=True)', consume(stream=True))
+
+
+def benchmark_parsing(repeat=20):
+    scraper = LegistarScraper()
+    scraper.BASE_URL = 'https://chicago.legistar.com'
+
+    tables = []
+    for jurisdiction in ('chicago', 'metro', 'nyc'):
+        for fixture in ('bills.html', 'events.html', 'people.html'):
+            with open(os.path.join(FIXTURES, jurisdiction, fixture)) as f:
+                page = lxml.html.fromstring(f.read())
+            tables += page.xpath("//table[contains(@class, 'rgMasterTable')]")
+
+    def parse_tables():
+        for _ in range(repeat):
+            for table in tables:
+                for row in scraper.parseDataTable(table):
+                    pass
+
+    def retained(compact):
+        tracemalloc.start()
+        rows = [row for table in tables
+                for row in scraper.parseDataTable(table, compact)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('  retained rows (compact={}){:>26.1f} KiB'.format(compact, size / 1024))
+        return rows
+
+    print('Grid parsing, fixtures x {}'.format(repeat))
+    measure('  parseDataTable', parse_tables)
+    retained(compact=False)
+    retained(compact=True)
+
+
+if __name__ == '__main__':
+    benchmark_api_pages()
+    benchmark_parsing()
@@ -1,7 +1,13 @@
+import asyncio
+import datetime
 import re
+import time
 
 import requests_mock
 
+from legistar.aio import AsyncLegistarAPIBillScraper
+from legistar.stores import DetailURLStore, DigestStore, ResponseCache, StateStore
+
 
 def test_topics(metro_api_bill_scraper, matter_index, all_indexes):
     with requests_mock.Mocker() as m:
@@ -58,3 +64,207 @@ def test_500_votes(chicago_api_bill_scraper):
               status_code=500)
         votes = chicago_api_bill_scraper.votes('408134')
         assert votes == []
+
+
+def test_matters_split_filter(chicago_api_bill_scraper, mocker):
+    mocker.patch.object(chicago_api_bill_scraper, 'legislation_detail_url',
+                        return_value='https://chicago.legistar.com/LegislationDetail.aspx')
+
+    def callback(request, context):
+        # Each sub-query finds a different, overlapping set of matters
+        if 'matterexdate1 ' in request.qs['$filter'][0]:
+            ids = [1, 3, 4]
+        else:
+            ids = [2, 3, 5]
+        return [{'MatterId': matter_id,
+                 'MatterLastModifiedUtc': '2017-01-0{}T00:00:00'.format(matter_id)}
+                for matter_id in ids]
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/matters'), json=callback)
+
+        matters = chicago_api_bill_scraper.matters(
+            since_datetime=datetime.datetime(2017, 1, 1))
+
+        assert [matter['MatterId'] for matter in matters] == [1, 2, 3, 4, 5]
+        assert m.call_count == 2
+        for request in m.request_history:
+            assert request.qs['$filter'][0].count(' or ') < 16
+            assert request.qs['$orderby'] == ['matterlastmodifiedutc,matterid']
+
+
+def test_revalidation_cache(chicago_api_bill_scraper, tmp_path, no_dupe_event):
+    chicago_api_bill_scraper.revalidation_cache = ResponseCache(
+        str(tmp_path / 'responses.db'))
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile('/matters/38769/histories'),
+              [{'json': no_dupe_event, 'headers': {'ETag': '"38769-1"'}},
+               {'status_code': 304}])
+
+        first = chicago_api_bill_scraper.history('38769')
+        second = chicago_api_bill_scraper.history('38769')
+
+        assert first == second
+        assert m.last_request.headers['If-None-Match'] == '"38769-1"'
+
+
+def test_async_history(chicago_api_bill_scraper, dupe_event, no_dupe_event):
+    async def histories():
+        async with AsyncLegistarAPIBillScraper(chicago_api_bill_scraper) as scraper:
+            return await asyncio.gather(scraper.history('38768'),
+                                        scraper.history('38769'))
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile('/matters/38768/histories'), json=dupe_event)
+        m.get(re.compile('/matters/38769/histories'), json=no_dupe_event)
+
+        dupe_history, no_dupe_history = asyncio.run(histories())
+
+        assert dupe_history == chicago_api_bill_scraper.history('38768')
+        assert no_dupe_history == chicago_api_bill_scraper.history('38769')
+
+
+def test_hydrate_matters(chicago_api_bill_scraper, matter_index, no_dupe_event):
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/histories'), json=no_dupe_event)
+        m.get(re.compile(r'/indexes'), json=matter_index)
+        m.get(re.compile(r'/sponsors'), status_code=404)
+
+        matters = [{'MatterId': matter_id} for matter_id in range(10)]
+        hydrated = list(chicago_api_bill_scraper.hydrate_matters(
+            matters, include=['history', 'topics', 'sponsors'], workers=3))
+
+    assert [matter['MatterId'] for matter in hydrated] == list(range(10))
+    for matter in hydrated:
+        assert len(matter['history']) == len(no_dupe_event)
+        assert matter['topics'] == matter_index
+        assert 'sponsors' not in matter
+        assert list(matter['hydration_errors']) == ['sponsors']
+
+
+def test_detail_url_store(chicago_api_bill_scraper, tmp_path):
+    chicago_api_bill_scraper.BASE_WEB_URL = 'https://chicago.legistar.com'
+    chicago_api_bill_scraper.detail_url_store = DetailURLStore(
+        str(tmp_path / 'detail_urls.db'))
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/matters'),
+              json=[{'MatterId': 1}, {'MatterId': 2}])
+        m.head(re.compile(r'gateway.aspx\?m=l&id=1'), status_code=302,
+               headers={'Location': '/LegislationDetail.aspx?ID=1'})
+        m.head(re.compile(r'gateway.aspx\?m=l&id=2'), status_code=200)
+
+        for _ in range(2):
+            matters = list(chicago_api_bill_scraper.matters())
+
+            assert matters == [{
+                'MatterId': 1,
+                'legistar_url': 'https://chicago.legistar.com/LegislationDetail.aspx?ID=1'}]
+
+        head_requests = [request for request in m.request_history
+                         if request.method == 'HEAD']
+        assert len(head_requests) == 2
+
+
+def test_detail_url_store_restricted_matter(chicago_api_bill_scraper, tmp_path):
+    chicago_api_bill_scraper.BASE_WEB_URL = 'https://chicago.legistar.com'
+    chicago_api_bill_scraper.detail_url_store = DetailURLStore(
+        str(tmp_path / 'detail_urls.db'))
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/matters'),
+              json=[{'MatterId': 1, 'MatterRestrictViewViaWeb': False}])
+        m.head(re.compile(r'gateway.aspx\?m=l&id=1'), status_code=302,
+               headers={'Location': '/LegislationDetail.aspx?ID=1'})
+
+        assert len(list(chicago_api_bill_scraper.matters())) == 1
+
+        # The matter is restricted after its URL was stored
+        m.get(re.compile(r'/matters'),
+              json=[{'MatterId': 1, 'MatterRestrictViewViaWeb': True}])
+        m.head(re.compile(r'gateway.aspx\?m=l&id=1'), status_code=200)
+
+        assert list(chicago_api_bill_scraper.matters()) == []
+
+
+def test_matters_resume_from_state_store(chicago_api_bill_scraper, tmp_path):
+    chicago_api_bill_scraper.BASE_WEB_URL = 'https://chicago.legistar.com'
+    chicago_api_bill_scraper.state_store = StateStore(str(tmp_path / 'state.db'))
+
+    matters = [{'MatterId': matter_id,
+                'MatterLastModifiedUtc': '2019-02-{:02}T16:23:41.39'.format(matter_id)}
+               for matter_id in (1, 2, 3)]
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/matters'), json=matters)
+        m.head(re.compile(r'gateway.aspx'), status_code=302,
+               headers={'Location': '/LegislationDetail.aspx?ID=1'})
+
+        assert len(list(chicago_api_bill_scraper.matters())) == 3
+        assert '$filter' not in m.request_history[0].qs
+
+        assert chicago_api_bill_scraper.high_water_mark('matters') == \
+            datetime.datetime(2019, 2, 3, 16, 23, 41, 390000)
+
+        list(chicago_api_bill_scraper.matters())
+
+        # The subqueries of the filter run concurrently, in any order
+        filters = [request.qs['$filter'][0] for request in m.request_history
+                   if request.method == 'GET' and '$filter' in request.qs]
+        assert any("matterlastmodifiedutc gt datetime'2019-02-03t16:23:41.390000'"
+                   in search_filter for search_filter in filters)
+
+
+def test_hydrate_matters_skips_unchanged(chicago_api_bill_scraper, matter_index,
+                                         no_dupe_event, tmp_path):
+    chicago_api_bill_scraper.digest_store = DigestStore(str(tmp_path / 'digests.db'))
+
+    def hydrate():
+        matters = [{'MatterId': matter_id} for matter_id in range(3)]
+        hydrated = chicago_api_bill_scraper.hydrate_matters(
+            matters, include=['history', 'topics'], workers=2)
+        return [matter['MatterId'] for matter in hydrated]
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/histories'), json=no_dupe_event)
+        m.get(re.compile(r'/indexes'), json=matter_index)
+
+        assert hydrate() == [0, 1, 2]
+        assert hydrate() == []
+
+        # A matter whose history has changed is yielded again
+        m.get(re.compile(r'/matters/1/histories'), json=no_dupe_event[:1])
+        assert hydrate() == [1]
+
+
+def test_legislation_detail_urls_throttled(chicago_api_bill_scraper):
+    chicago_api_bill_scraper.BASE_WEB_URL = 'https://chicago.legistar.com'
+    chicago_api_bill_scraper.requests_per_minute = 600
+
+    with requests_mock.Mocker() as m:
+        m.head(re.compile(r'gateway.aspx'), status_code=302,
+               headers={'Location': '/LegislationDetail.aspx?ID=1'})
+
+        start = time.monotonic()
+        detail_urls = chicago_api_bill_scraper.legislation_detail_urls(range(5))
+        for detail_url in detail_urls.values():
+            detail_url.result()
+
+        # At ten requests a second, however many threads send them
+        assert time.monotonic() - start >= 0.35
+
+
+def test_hydrate_matters_stops_early(chicago_api_bill_scraper, no_dupe_event):
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/histories'), json=no_dupe_event)
+
+        matters = [{'MatterId': matter_id} for matter_id in range(100)]
+        hydrated = chicago_api_bill_scraper.hydrate_matters(
+            matters, include=['history'], workers=2)
+
+        assert next(hydrated)['MatterId'] == 0
+        hydrated.close()
+
+        # Only the matters in the window were fetched
+        assert m.call_count <= 3
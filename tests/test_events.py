@@ -0,0 +1,241 @@
+import asyncio
+import datetime
+import re
+import time
+
+import pytz
+import requests_mock
+
+from legistar.aio import AsyncLegistarAPIEventScraper
+from legistar.events import LegistarAPIEventScraperZip
+from legistar.stores import DigestStore, EventTimeStore
+
+
+ICAL = '''BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+DTSTART:20190131T120000
+SUMMARY:Committee on Finance
+END:VEVENT
+END:VCALENDAR
+'''
+
+
+class ZipEventScraper(LegistarAPIEventScraperZip):
+    BASE_URL = 'https://webapi.legistar.com/v1/nyc'
+    WEB_URL = 'https://nyc.legistar.com'
+    EVENTSPAGE = 'https://nyc.legistar.com/Calendar.aspx'
+    TIMEZONE = 'America/New_York'
+
+
+def web_event(name, date, time, event_id):
+    return {'Name': {'label': name},
+            'Meeting Date': date,
+            'Meeting Time': time,
+            'iCalendar': {'url': 'https://nyc.legistar.com/View.ashx?M=IC&ID={}'.format(event_id)}}
+
+
+def test_event_keys_from_calendar(mocker, tmp_path):
+    tz = pytz.timezone('America/New_York')
+    store = EventTimeStore(str(tmp_path / 'event_times.db'))
+
+    web_events = [web_event('City Council', '1/31/2019', '1:30 PM', 1),
+                  web_event('Committee on Finance', '1/31/2019', 'Deferred', 2)]
+
+    ical_requests = []
+
+    for _ in range(2):
+        scraper = ZipEventScraper()
+        scraper.event_time_store = store
+        mocker.patch.object(scraper._webscraper, 'events',
+                            return_value=((event, None) for event in web_events))
+
+        with requests_mock.Mocker() as m:
+            m.get('https://nyc.legistar.com/View.ashx?M=IC&ID=2', text=ICAL)
+
+            keys = [key for key, _ in scraper._scrapeWebCalendar()]
+            ical_requests.append(m.call_count)
+
+        assert keys == [
+            ('City Council', tz.localize(datetime.datetime(2019, 1, 31, 13, 30))),
+            ('Committee on Finance', tz.localize(datetime.datetime(2019, 1, 31, 12, 0)))]
+
+    # Only the event without a clear time needed its iCalendar file,
+    # and only the first time
+    assert ical_requests == [1, 0]
+
+
+def test_web_results_match_with_tolerance(mocker):
+    tz = pytz.timezone('America/New_York')
+
+    scraper = ZipEventScraper()
+    scraper.EVENT_TIME_TOLERANCE = datetime.timedelta(minutes=15)
+
+    def calendar():
+        yield (('Committee on  Finance', tz.localize(datetime.datetime(2019, 3, 1, 10, 0))),
+               {'id': 'finance'})
+        yield (('City Council', tz.localize(datetime.datetime(2019, 1, 31, 13, 30))),
+               {'id': 'council'})
+        yield (('City Council', tz.localize(datetime.datetime(2018, 12, 20, 13, 30))),
+               {'id': 'last council of 2018'})
+        raise AssertionError('Scraped the whole calendar')
+
+    scraper._events = calendar()
+
+    def api_event(name, start):
+        return {'EventBodyName': name, 'start': tz.localize(start)}
+
+    assert scraper.web_results(
+        api_event('City Council', datetime.datetime(2019, 1, 31, 13, 40))) == {'id': 'council'}
+
+    # Not in the calendar, but we stop looking once we reach 2018
+    assert scraper.web_results(
+        api_event('City Council', datetime.datetime(2019, 1, 10, 10, 0))) is None
+
+    # Already scraped
+    assert scraper.web_results(
+        api_event('COMMITTEE ON FINANCE', datetime.datetime(2019, 3, 1, 9, 50))) == {'id': 'finance'}
+    assert scraper.web_results(
+        api_event('City Council', datetime.datetime(2018, 12, 20, 13, 30))) == \
+        {'id': 'last council of 2018'}
+
+
+def test_event_items_fetched_once():
+    scraper = ZipEventScraper()
+    scraper.retry_attempts = 0
+    scraper.requests_per_minute = 0
+
+    items = [{'EventItemId': item_id,
+              'EventItemTitle': 'Item {}'.format(item_id),
+              'EventItemAgendaSequence': item_id,
+              'EventItemMinutesSequence': 10 - item_id,
+              'EventItemRollCallFlag': item_id % 2}
+             for item_id in range(1, 6)]
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/events/1/eventitems'), json=items)
+        m.get(re.compile(r'/eventitems/\d+/rollcalls'),
+              json=lambda request, context: [{'RollCallUrl': request.path}])
+
+        event = {'EventId': 1}
+        agenda = list(scraper.agenda(event))
+        minutes = list(scraper.minutes(event))
+        rollcalls = list(scraper.rollcalls(event))
+
+        item_requests = [request for request in m.request_history
+                         if request.path.endswith('/eventitems')]
+
+    assert len(item_requests) == 1
+    assert [item['EventItemId'] for item in agenda] == [1, 2, 3, 4, 5]
+    assert [item['EventItemId'] for item in minutes] == [5, 4, 3, 2, 1]
+    assert [rollcall['RollCallUrl'] for rollcall in rollcalls] == [
+        '/v1/nyc/eventitems/{}/rollcalls'.format(item_id) for item_id in (1, 3, 5)]
+
+
+def test_events_skips_unchanged(mocker, tmp_path):
+    digest_store = DigestStore(str(tmp_path / 'digests.db'))
+
+    items = [{'EventItemId': 1,
+              'EventItemTitle': 'Roll Call',
+              'EventItemAgendaSequence': 1,
+              'EventItemMinutesSequence': 1,
+              'EventItemRollCallFlag': 1}]
+
+    def scrape():
+        scraper = ZipEventScraper()
+        scraper.retry_attempts = 0
+        scraper.requests_per_minute = 0
+        scraper.digest_store = digest_store
+
+        event = ({'EventId': 1}, {'id': 'web event'})
+        mocker.patch.object(scraper, '_events', return_value=iter([event]))
+
+        return [api_event['EventId'] for api_event, _ in scraper.events()]
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/events/1/eventitems'), json=items)
+        m.get(re.compile(r'/eventitems/1/rollcalls'),
+              json=[{'RollCallPersonName': 'A', 'RollCallValueName': 'Present'}])
+
+        assert scrape() == [1]
+        assert scrape() == []
+
+        # Only the event's roll call has changed
+        m.get(re.compile(r'/eventitems/1/rollcalls'),
+              json=[{'RollCallPersonName': 'A', 'RollCallValueName': 'Absent'}])
+        assert scrape() == [1]
+
+
+def test_web_results_closest_match(mocker):
+    tz = pytz.timezone('America/New_York')
+
+    def calendar():
+        yield (('City Council', tz.localize(datetime.datetime(2019, 1, 31, 13, 30))),
+               {'id': 'later'})
+        yield (('City Council', tz.localize(datetime.datetime(2019, 1, 31, 13, 20))),
+               {'id': 'closer'})
+        yield (('City Council', tz.localize(datetime.datetime(2019, 1, 10, 13, 30))),
+               {'id': 'earlier'})
+        raise AssertionError('Scraped the whole calendar')
+
+    def api_event(start):
+        return {'EventBodyName': 'City Council', 'start': tz.localize(start)}
+
+    start = datetime.datetime(2019, 1, 31, 13, 22)
+
+    # Whether or not the web events have already been scraped, the
+    # closest one is the match
+    scraper = ZipEventScraper()
+    scraper.EVENT_TIME_TOLERANCE = datetime.timedelta(minutes=15)
+    scraper._events = calendar()
+
+    assert scraper.web_results(api_event(start)) == {'id': 'closer'}
+    assert scraper.web_results(api_event(start)) == {'id': 'closer'}
+
+
+def test_web_results_stop_at_earlier_date(mocker):
+    tz = pytz.timezone('America/New_York')
+
+    def calendar():
+        yield (('City Council', tz.localize(datetime.datetime(2019, 12, 20, 13, 30))),
+               {'id': 'council'})
+        yield (('City Council', tz.localize(datetime.datetime(2019, 12, 19, 13, 30))),
+               {'id': 'earlier council'})
+        raise AssertionError('Scraped past the API event')
+
+    scraper = ZipEventScraper()
+    scraper._events = calendar()
+
+    # Once the walk reaches an earlier day, there is no match to come
+    assert scraper.web_results(
+        {'EventBodyName': 'Committee on Finance',
+         'start': tz.localize(datetime.datetime(2019, 12, 20, 10, 0))}) is None
+
+
+def test_async_events_share_the_calendar():
+    tz = pytz.timezone('America/New_York')
+    days = range(20, 10, -1)
+
+    def calendar():
+        for day in days:
+            time.sleep(0.01)
+            yield (('City Council', tz.localize(datetime.datetime(2019, 12, day, 10, 0))),
+                   {'id': day})
+
+    scraper = ZipEventScraper()
+    scraper._events = calendar()
+
+    def api_event(day):
+        return {'EventId': day,
+                'EventBodyName': 'City Council',
+                'EventDate': '2019-12-{}T00:00:00'.format(day),
+                'EventTime': '10:00 AM'}
+
+    async def events():
+        async with AsyncLegistarAPIEventScraper(scraper, concurrency=4) as async_scraper:
+            return await asyncio.gather(*(async_scraper.event(api_event(day))
+                                          for day in (12, 18, 15, 20)))
+
+    web_events = [web_event for _, web_event in asyncio.run(events())]
+
+    assert web_events == [{'id': 12}, {'id': 18}, {'id': 15}, {'id': 20}]
@@ -0,0 +1,47 @@
+import datetime
+
+import pytest
+
+from legistar import odata
+
+
+def test_filter_str():
+    since = datetime.datetime(2017, 1, 1)
+    search_filter = (odata.Field('MatterIntroDate').gt(since) |
+                     odata.Field('MatterFile').eq("O'2010-5046")) & \
+        odata.Field('MatterId').gt(5)
+
+    assert str(search_filter) == (
+        "(MatterIntroDate gt datetime'2017-01-01T00:00:00' or "
+        "MatterFile eq 'O''2010-5046') and MatterId gt 5")
+    assert search_filter.terms == 3
+
+
+def test_split_or():
+    search_filter = odata.Or(*(odata.Field('MatterDate{}'.format(i)).gt(i)
+                               for i in range(17)))
+
+    parts = search_filter.split(16)
+
+    assert [part.terms for part in parts] == [16, 1]
+    assert str(parts[1]) == 'MatterDate16 gt 16'
+
+
+def test_split_and():
+    dates = odata.Or(*(odata.Field('MatterDate{}'.format(i)).gt(i)
+                       for i in range(6)))
+    search_filter = odata.Field('MatterBodyId').eq(1) & dates
+
+    parts = search_filter.split(4)
+
+    assert len(parts) == 2
+    assert all(part.terms <= 4 for part in parts)
+    assert str(parts[0]) == ('MatterBodyId eq 1 and '
+                             '(MatterDate0 gt 0 or MatterDate1 gt 1 or MatterDate2 gt 2)')
+
+
+def test_split_impossible():
+    search_filter = odata.Field('MatterBodyId').eq(1) & odata.Field('MatterId').eq(2)
+
+    with pytest.raises(ValueError):
+        search_filter.split(1)
@@ -1,11 +1,21 @@
+import datetime
 import os
+import random
+import re
+import time
+from urllib.parse import parse_qs
 
 import lxml
 import pytest
+import requests
+import requests_mock
+import scrapelib
 
+from legistar.base import LegistarScraper
 from legistar.bills import LegistarBillScraper
 from legistar.events import LegistarEventsScraper
 from legistar.people import LegistarPersonScraper
+from legistar.stores import CheckpointStore
 
 
 @pytest.mark.parametrize('jurisdiction', ['chicago', 'metro', 'nyc'])
@@ -47,3 +57,409 @@ def test_parse_people(project_directory, mocker, jurisdiction):
         mocker.patch.object(scraper, 'pages', return_value=page)
         result = next(scraper.councilMembers(follow_links=False))
         print(result)
+
+
+@pytest.mark.parametrize('jurisdiction', ['chicago', 'metro', 'nyc'])
+def test_parse_compact_rows(project_directory, jurisdiction):
+    bills_fixture = os.path.join(project_directory, 'tests', 'fixtures', jurisdiction, 'bills.html')
+
+    scraper = LegistarBillScraper()
+    scraper.BASE_URL = '{}.legistar.com'.format(jurisdiction)
+
+    with open(bills_fixture, 'r') as f:
+        page = lxml.html.fromstring(f.read())
+
+    results = list(scraper.parseSearchResults(page))
+    compact_results = list(scraper.parseSearchResults(page, compact=True))
+
+    assert compact_results == results
+    assert [list(row.items()) for row in compact_results] == \
+        [list(row.items()) for row in results]
+
+
+def test_pages_reads_secrets_from_text(fixtures_directory):
+    with open(os.path.join(fixtures_directory, 'chicago', 'bills.html')) as f:
+        first_page = f.read()
+    with open(os.path.join(fixtures_directory, 'chicago', 'people.html')) as f:
+        last_page = f.read()
+
+    first_tree = lxml.html.fromstring(first_page)
+    view_state, = first_tree.xpath("//input[@name='__VIEWSTATE']/@value")
+
+    scraper = LegistarScraper(retry_attempts=0, requests_per_minute=0)
+    url = 'https://chicago.legistar.com/Legislation.aspx'
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=first_page)
+        m.post(url, text=last_page)
+
+        pages = list(scraper.pages(url))
+
+        postback = parse_qs(m.request_history[-1].text)
+
+    assert len(pages) == 2
+    assert postback['__VIEWSTATE'] == [view_state]
+    assert postback['__EVENTTARGET'] == \
+        ['ctl00%24ContentPlaceHolder1%24gridMain%24ctl00%24ctl02%24ctl00%24ctl04']
+
+    # The trees hold a placeholder rather than the ViewState itself
+    placeholder, = pages[0].xpath("//input[@name='__VIEWSTATE']/@value")
+    assert len(placeholder) < 100
+    assert scraper.sessionSecrets(pages[0])['__VIEWSTATE'] == view_state
+
+
+def test_secrets_of_cached_pages_are_kept(fixtures_directory):
+    with open(os.path.join(fixtures_directory, 'chicago', 'bills.html')) as f:
+        page_text = f.read()
+
+    view_state, = lxml.html.fromstring(page_text).xpath(
+        "//input[@name='__VIEWSTATE']/@value")
+
+    scraper = LegistarScraper(retry_attempts=0, requests_per_minute=0)
+    url = 'https://chicago.legistar.com/Legislation.aspx'
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=page_text)
+        cached = scraper.lxmlize(url)
+
+    uncached = scraper._parse(page_text, url)
+    for _ in range(scraper.SECRETS_KEPT):
+        scraper._parse(page_text, url)
+
+    # The cached page's ViewState outlasts those of newer, uncached pages
+    assert scraper.sessionSecrets(cached)['__VIEWSTATE'] == view_state
+    with pytest.raises(ValueError):
+        scraper.sessionSecrets(uncached)
+
+    scraper.invalidatePages(url)
+    with pytest.raises(ValueError):
+        scraper.sessionSecrets(cached)
+
+
+@pytest.mark.parametrize('jurisdiction', ['chicago', 'metro', 'nyc'])
+def test_events_agendas_in_order(project_directory, mocker, jurisdiction):
+    events_fixture = os.path.join(project_directory, 'tests', 'fixtures', jurisdiction, 'events.html')
+
+    scraper = LegistarEventsScraper()
+    scraper.BASE_URL = '{}.legistar.com'.format(jurisdiction)
+
+    def agenda(detail_url):
+        time.sleep(random.random() / 100)
+        return iter([detail_url])
+
+    with open(events_fixture, 'r') as f:
+        page = lxml.html.fromstring(f.read())
+
+    next_year = scraper.now().year + 1
+    mocker.patch.object(scraper, 'eventPages',
+                        side_effect=lambda year: [page] if year == next_year else [])
+    mocker.patch.object(scraper, 'agenda', side_effect=agenda)
+
+    events = [event for event, _ in scraper.events(follow_links=False)]
+    results = list(scraper.events(follow_links=True))
+
+    assert events
+    assert [event for event, _ in results] == events
+    for event, agenda in results:
+        if type(event[scraper.event_info_key]) == dict:
+            assert agenda == [event[scraper.event_info_key]['url']]
+        else:
+            assert agenda is None
+
+
+def test_lxmlize_caches_pages(fixtures_directory):
+    with open(os.path.join(fixtures_directory, 'chicago', 'people.html')) as f:
+        detail_page = f.read()
+
+    scraper = LegistarBillScraper(retry_attempts=0, requests_per_minute=0)
+    url = 'https://chicago.legistar.com/LegislationDetail.aspx?ID=1'
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=detail_page)
+        m.post(url, text=detail_page)
+
+        assert scraper.text(url) is None
+        page = scraper.lxmlize(url)
+        assert scraper.lxmlize(url) is page
+        assert m.call_count == 1
+
+        scraper.lxmlize(url, {'__EVENTTARGET': 'x'})
+        assert m.call_count == 2
+
+        scraper.invalidatePages(url)
+        assert scraper.lxmlize(url) is not page
+        assert m.call_count == 3
+
+    assert scraper.page_cache_hits == 2
+    assert scraper.page_cache_misses == 3
+
+
+def test_with_details_throttled():
+    scraper = LegistarBillScraper(retry_attempts=0, requests_per_minute=600)
+    url = 'https://chicago.legistar.com/PersonDetail.aspx?ID={}'
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile('PersonDetail.aspx'), text='details')
+
+        start = time.monotonic()
+        details = scraper.withDetails(range(5),
+                                      lambda row: scraper.get(url.format(row)).text)
+        assert [detail for _, detail in details] == ['details'] * 5
+
+        # At ten requests a second, however many threads send them
+        assert time.monotonic() - start >= 0.35
+
+
+def test_search_form_fetched_fresh(fixtures_directory):
+    with open(os.path.join(fixtures_directory, 'chicago', 'bills.html')) as f:
+        search_page = f.read()
+
+    scraper = LegistarBillScraper(retry_attempts=0, requests_per_minute=0)
+    scraper.LEGISLATION_URL = 'https://chicago.legistar.com/Legislation.aspx'
+    scraper.GRID_PAGE_SIZE = 0
+
+    with requests_mock.Mocker() as m:
+        m.get(scraper.LEGISLATION_URL, text=search_page)
+        m.post(scraper.LEGISLATION_URL, text=search_page)
+
+        for _ in range(2):
+            next(scraper.searchLegislation())
+
+        # Every search posts back the ViewState of a fresh search form
+        assert [request.method for request in m.request_history] == \
+            ['GET', 'POST', 'GET', 'POST']
+
+
+def test_pages_resizes_grid(fixtures_directory):
+    with open(os.path.join(fixtures_directory, 'chicago', 'bills.html')) as f:
+        first_page = f.read()
+
+    # After resizing, all the results fit on one page
+    resized_page = first_page.replace('\\"PageSize\\":100', '\\"PageSize\\":1000')
+    resized_page = resized_page.replace('class="rgCurrentPage"', 'class="rgCurrentPageOnly"')
+
+    scraper = LegistarScraper(retry_attempts=0, requests_per_minute=0)
+    url = 'https://chicago.legistar.com/Legislation.aspx'
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=first_page)
+        m.post(url, text=resized_page)
+
+        pages = list(scraper.pages(url))
+
+        resize = parse_qs(m.request_history[1].text)
+
+    assert len(pages) == 1
+    assert m.call_count == 2
+    assert resize['__EVENTTARGET'] == ['ctl00$ContentPlaceHolder1$gridMain']
+    assert resize['__EVENTARGUMENT'] == \
+        ['FireCommand:ctl00$ContentPlaceHolder1$gridMain$ctl00;PageSize;1000']
+
+
+def test_pages_without_resizing_grid(fixtures_directory):
+    with open(os.path.join(fixtures_directory, 'chicago', 'bills.html')) as f:
+        first_page = f.read()
+    with open(os.path.join(fixtures_directory, 'chicago', 'people.html')) as f:
+        last_page = f.read()
+
+    scraper = LegistarScraper(retry_attempts=0, requests_per_minute=0)
+    url = 'https://chicago.legistar.com/Legislation.aspx'
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=first_page)
+        # The server ignores the resize, and shows the first page again
+        m.post(url, [{'text': first_page}, {'text': last_page}])
+
+        pages = list(scraper.pages(url))
+
+        postback = parse_qs(m.request_history[-1].text)
+
+    assert len(pages) == 2
+    assert m.call_count == 3
+    assert postback['__EVENTTARGET'] == \
+        ['ctl00%24ContentPlaceHolder1%24gridMain%24ctl00%24ctl02%24ctl00%24ctl04']
+
+
+def test_pages_resume_from_checkpoint(fixtures_directory):
+    with open(os.path.join(fixtures_directory, 'chicago', 'bills.html')) as f:
+        first_page = f.read()
+    with open(os.path.join(fixtures_directory, 'chicago', 'people.html')) as f:
+        last_page = f.read()
+
+    store = CheckpointStore(':memory:')
+    url = 'https://chicago.legistar.com/Legislation.aspx'
+
+    def scraper():
+        scraper = LegistarScraper(retry_attempts=0, requests_per_minute=0)
+        scraper.GRID_PAGE_SIZE = 0
+        scraper.checkpoint_store = store
+        return scraper
+
+    first_scraper = scraper()
+    checkpoint = first_scraper.checkpoint('legislation', url)
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=first_page)
+        m.post(url, status_code=500)
+
+        pages = []
+        with pytest.raises(scrapelib.HTTPError):
+            for page in first_scraper.pages(url, checkpoint=checkpoint):
+                pages.append(page)
+                checkpoint.emit(100)
+
+    assert len(pages) == 1
+
+    # Pick up in a new scraper, from the second page
+    second_scraper = scraper()
+    checkpoint = second_scraper.checkpoint('legislation', url)
+    assert checkpoint.resumable
+    assert checkpoint.rows == 100
+
+    with requests_mock.Mocker() as m:
+        m.post(url, text=last_page)
+
+        pages = list(second_scraper.pages(url, checkpoint=checkpoint))
+
+        postback = parse_qs(m.request_history[0].text)
+
+    assert len(pages) == 1
+    assert m.call_count == 1
+    assert postback['__EVENTTARGET'] == \
+        ['ctl00%24ContentPlaceHolder1%24gridMain%24ctl00%24ctl02%24ctl00%24ctl04']
+    assert not checkpoint.resumable
+
+
+def test_stopped_walk_starts_over(fixtures_directory, mocker):
+    with open(os.path.join(fixtures_directory, 'chicago', 'bills.html')) as f:
+        first_page = f.read()
+    with open(os.path.join(fixtures_directory, 'chicago', 'people.html')) as f:
+        last_page = f.read()
+
+    store = CheckpointStore(':memory:')
+    url = 'https://chicago.legistar.com/Legislation.aspx'
+
+    scraper = LegistarBillScraper(retry_attempts=0, requests_per_minute=0)
+    scraper.LEGISLATION_URL = url
+    scraper.GRID_PAGE_SIZE = 0
+    scraper.checkpoint_store = store
+
+    mocker.patch.object(scraper, 'searchLegislation',
+                        side_effect=lambda *args: scraper.pages(url, checkpoint=args[-1]))
+    mocker.patch.object(scraper, 'parseSearchResults',
+                        side_effect=lambda page, compact: [{'url': str(id(page))}])
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=first_page)
+        m.post(url, text=last_page)
+
+        # Stop after the first row of the second page
+        legislation = scraper.legislation()
+        next(legislation)
+        next(legislation)
+        legislation.close()
+
+        assert m.request_history[-1].method == 'POST'
+
+        legislation = scraper.legislation()
+        next(legislation)
+        legislation.close()
+
+        # The next walk starts from the first page, not the second
+        assert m.request_history[-1].method == 'GET'
+
+    assert not scraper.checkpoint('legislation', url, '', None, None).resumable
+
+
+def test_failed_walk_keeps_checkpoint(fixtures_directory, mocker):
+    with open(os.path.join(fixtures_directory, 'chicago', 'bills.html')) as f:
+        first_page = f.read()
+    with open(os.path.join(fixtures_directory, 'chicago', 'people.html')) as f:
+        last_page = f.read()
+
+    url = 'https://chicago.legistar.com/Legislation.aspx'
+
+    scraper = LegistarBillScraper(retry_attempts=0, requests_per_minute=0)
+    scraper.LEGISLATION_URL = url
+    scraper.GRID_PAGE_SIZE = 0
+    scraper.checkpoint_store = CheckpointStore(':memory:')
+
+    def parse(page, compact):
+        # The second page is an error page
+        if 'gridMain' not in lxml.html.tostring(page).decode():
+            raise IndexError('list index out of range')
+        return [{'url': 'first'}]
+
+    mocker.patch.object(scraper, 'searchLegislation',
+                        side_effect=lambda *args: scraper.pages(url, checkpoint=args[-1]))
+    mocker.patch.object(scraper, 'parseSearchResults', side_effect=parse)
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=first_page)
+        m.post(url, text=last_page)
+
+        with pytest.raises(IndexError):
+            list(scraper.legislation())
+
+    # The next walk picks up from the page that failed
+    assert scraper.checkpoint('legislation', url, '', None, None).resumable
+
+
+@pytest.mark.parametrize('jurisdiction', ['chicago', 'metro', 'nyc'])
+def test_events_years_in_parallel(project_directory, mocker, jurisdiction):
+    events_fixture = os.path.join(project_directory, 'tests', 'fixtures', jurisdiction, 'events.html')
+
+    scraper = LegistarEventsScraper()
+    scraper.BASE_URL = '{}.legistar.com'.format(jurisdiction)
+
+    with open(events_fixture, 'r') as f:
+        page = lxml.html.fromstring(f.read())
+
+    # The calendar has events in the next two years, then none
+    current_year = scraper.now().year
+    mocker.patch.object(scraper, 'eventPages',
+                        side_effect=lambda year: [page] if year >= current_year else [])
+
+    events = list(scraper.events(follow_links=False))
+
+    scraper.YEAR_WORKERS = 3
+    assert list(scraper.events(follow_links=False)) == events
+
+    clone = scraper.clone()
+    assert clone.cookies is not scraper.cookies
+    assert clone.adapters['https://'] is not scraper.adapters['https://']
+
+
+def test_legislation_by_window(project_directory, mocker):
+    bills_fixture = os.path.join(project_directory, 'tests', 'fixtures', 'chicago', 'bills.html')
+
+    scraper = LegistarBillScraper()
+    scraper.BASE_URL = 'chicago.legistar.com'
+    scraper.LEGISLATION_URL = 'https://chicago.legistar.com/Legislation.aspx'
+
+    with open(bills_fixture, 'r') as f:
+        page = lxml.html.fromstring(f.read())
+
+    searches = []
+
+    def search(search_text, created_after, created_before, checkpoint):
+        searches.append((created_after, created_before))
+        # The search of the second window fails the first time
+        if searches.count((created_after, created_before)) == 1 and \
+                created_after == datetime.date(2020, 1, 31):
+            raise requests.ConnectionError('Connection reset')
+        return [page]
+
+    mocker.patch.object(scraper, 'searchLegislation', side_effect=search)
+
+    results = list(scraper.legislation(created_after=datetime.date(2020, 1, 1),
+                                       created_before=datetime.date(2020, 3, 15),
+                                       window=datetime.timedelta(days=30)))
+
+    # Every window finds the same legislation, which we only yield once
+    assert results == list(scraper.parseSearchResults(page))
+    assert sorted(set(searches)) == [
+        (datetime.date(2020, 1, 1), datetime.date(2020, 1, 31)),
+        (datetime.date(2020, 1, 31), datetime.date(2020, 3, 1)),
+        (datetime.date(2020, 3, 1), datetime.date(2020, 3, 15))]
+    assert len(searches) == 4
@@ -0,0 +1,43 @@
+import re
+
+import pytest
+import requests_mock
+import scrapelib
+
+from legistar.bills import LegistarAPIBillScraper
+from legistar.ratelimit import RateLimiter
+
+
+def test_adapts_to_failures():
+    limiter = RateLimiter(requests_per_minute=60, speed_up_after=2)
+    url = 'https://webapi.legistar.com/v1/chicago/matters'
+
+    limiter.failure(url)
+    assert limiter.requests_per_minute(url) == 30
+
+    # Other hosts are limited separately
+    assert limiter.requests_per_minute('https://chicago.legistar.com') == 60
+
+    limiter.success(url)
+    limiter.success(url)
+    assert limiter.requests_per_minute(url) == 36
+
+
+def test_shared_by_scrapers():
+    limiter = RateLimiter(requests_per_minute=6000)
+
+    scrapers = [LegistarAPIBillScraper(), LegistarAPIBillScraper()]
+    for scraper in scrapers:
+        scraper.BASE_URL = 'https://webapi.legistar.com/v1/chicago'
+        scraper.rate_limiter = limiter
+        assert scraper.requests_per_minute == 0
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/matters/1/histories'), status_code=500,
+              json={'Message': 'An error has occurred.'})
+
+        for scraper in scrapers:
+            with pytest.raises(scrapelib.HTTPError):
+                scraper.history(1)
+
+    assert limiter.requests_per_minute(scrapers[0].BASE_URL) == 1500
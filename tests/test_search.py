@@ -1,4 +1,11 @@
+import json
+import re
+import time
+
 import pytest
+import requests_mock
+
+from legistar import base
 
 
 class TestAPISearch(object):
@@ -14,3 +21,123 @@ class TestAPISearch(object):
                                  "MatterFile eq 'O2010-5046'")
 
         assert len(list(results)) == 1
+
+
+def paged_matters(total):
+    def callback(request, context):
+        skip = int(request.qs.get('$skip', ['0'])[0])
+        return [{'MatterId': matter_id}
+                for matter_id in range(skip, min(skip + 1000, total))]
+    return callback
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_pages(scraper, workers):
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/matters'), json=paged_matters(2500))
+
+        matters = scraper.pages(scraper.BASE_URL + '/matters',
+                                item_key='MatterId',
+                                workers=workers)
+
+        assert [matter['MatterId'] for matter in matters] == list(range(2500))
+
+
+def test_keyset_pages(scraper):
+    def callback(request, context):
+        params = request.qs
+        assert '$skip' not in params
+        after = re.search(r'matterlastmodifiedutc gt (\d+)', params.get('$filter', [''])[0])
+        start = int(after.group(1)) + 1 if after else 0
+        return [{'MatterId': matter_id, 'MatterLastModifiedUtc': matter_id}
+                for matter_id in range(start, min(start + 1000, 2000))]
+
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/matters'), json=callback)
+
+        matters = scraper.pages(scraper.BASE_URL + '/matters',
+                                params={'$orderby': 'MatterLastModifiedUtc'},
+                                item_key='MatterId',
+                                keyset=True)
+
+        assert [matter['MatterId'] for matter in matters] == list(range(2000))
+        assert m.call_count == 3
+        assert m.last_request.qs['$orderby'] == ['matterlastmodifiedutc,matterid']
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_iter_json_array(chunk_size):
+    items = [{'MatterId': 1, 'MatterName': 'A "quoted", [bracketed] name'},
+             {'MatterId': 23, 'MatterName': None},
+             12345]
+    text = json.dumps(items, indent=1)
+    chunks = (text[i:i + chunk_size] for i in range(0, len(text), chunk_size))
+
+    assert list(base.iter_json_array(chunks)) == items
+
+
+def test_stream_pages(scraper):
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/matters'), json=paged_matters(1500))
+
+        matters = scraper.pages(scraper.BASE_URL + '/matters',
+                                item_key='MatterId',
+                                stream=True)
+
+        assert [matter['MatterId'] for matter in matters] == list(range(1500))
+        assert m.call_count == 2
+
+
+def test_pages_fields(scraper):
+    with requests_mock.Mocker() as m:
+        m.get(re.compile(r'/matters'), json=[])
+
+        list(scraper.pages(scraper.BASE_URL + '/matters',
+                           params={'$orderby': 'MatterLastModifiedUtc'},
+                           item_key='MatterId',
+                           fields=['MatterLastModifiedUtc', 'MatterFile']))
+
+        assert m.last_request.qs['$select'] == [
+            'matterlastmodifiedutc,matterfile,matterid']
+
+
+def test_recent_set():
+    seen = base.RecentSet(maxlen=2)
+
+    assert seen.add('a')
+    assert seen.add('b')
+    assert not seen.add('a')
+    assert seen.add('c')
+
+    # 'a' has dropped out of the window
+    assert 'a' not in seen
+    assert seen.add('a')
+
+    assert len(seen) == 2
+    assert seen.duplicates == 1
+
+
+def test_prefetch():
+    produced = []
+
+    def items():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    prefetched = base.prefetch(items(), 2)
+    assert next(prefetched) == 0
+    prefetched.close()
+
+    # The producer stops soon after the consumer does
+    time.sleep(0.5)
+    assert len(produced) <= 5
+
+    def failing():
+        yield 1
+        raise ValueError('Bad page')
+
+    prefetched = base.prefetch(failing(), 2)
+    assert next(prefetched) == 1
+    with pytest.raises(ValueError):
+        next(prefetched)